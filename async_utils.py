@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Async versions of the Spotify helpers in utils.py.
+
+The a* coroutines talk to the Web API through httpx.AsyncClient and return
+exactly what their utils.py counterparts return. Fan-out work (searching
+for many tracks, fetching every page of a large playlist or playlist list)
+runs concurrently in one event loop instead of one request after another.
+
+The plain functions at the bottom are a sync facade with the same names and
+signatures as utils.py, so registry.py can switch to this module without
+spotify.py noticing. They run the coroutines on a background event loop
+shared by the process. Playback helpers make one or two calls each, so the
+facade hands them straight to utils.py.
+"""
+
+import asyncio
+import threading
+
+import httpx
+from spotipy.exceptions import SpotifyException
+
+import cache
+import telemetry
+import transport
+import utils
+from playlist_index import WRITE_THRESHOLD, match_playlist
+from ratelimit import retry_after
+from singleflight import flights
+from utils import PLAYLIST_WRITE_CHUNK, SEARCH_MAX_WORKERS, SEARCH_TIMEOUT, chunked
+from utils import pause, start, play_track, play_playlist, play_album, add_items_to_queue, clear_queue
+
+API_URL = "https://api.spotify.com/v1/"
+PAGE_CONCURRENCY = 8   # pages of one listing fetched at the same time
+MAX_429_RETRIES = 3
+
+log = telemetry.get_logger('async_utils')
+
+class AsyncSpotify:
+    """The few Web API calls the helpers need, on a shared httpx.AsyncClient.
+    Requests take tokens from the same process-wide bucket as the shared requests session."""
+
+    def __init__(self, client, token, bucket):
+        self.client = client
+        self.token = token
+        self.bucket = bucket
+
+    async def _request(self, method, url, params=None, payload=None):
+        if not url.startswith("http"):
+            url = API_URL + url
+        endpoint = telemetry.endpoint(url)
+        for attempt in range(MAX_429_RETRIES + 1):
+            await self.bucket.aacquire()
+            with telemetry.span('spotify', method=method, endpoint=endpoint):
+                response = await self.client.request(method, url, params=params, json=payload,
+                                                     headers={"Authorization": f"Bearer {self.token}"})
+            telemetry.incr('spotify_requests_total', method=method, endpoint=endpoint, status=response.status_code)
+            if response.status_code != 429 or attempt == MAX_429_RETRIES:
+                break
+            telemetry.incr('spotify_throttled_total')
+            if not self.bucket.pause(retry_after(response.headers)):   # every session waits, not just this request
+                telemetry.incr('spotify_throttled_failed_total')
+                break
+        if response.status_code == 429:   # as spotipy reports it
+            raise SpotifyException(429, -1, f"{endpoint}: too many requests", headers=dict(response.headers))
+        response.raise_for_status()
+        return response.json() if response.content else None
+
+    async def search(self, q, type, limit=10):
+        return await self._request("GET", "search", {"q": q, "type": type, "limit": limit})
+
+    async def artist_top_tracks(self, artist_id, country="US"):
+        return await self._request("GET", f"artists/{artist_id}/top-tracks", {"country": country})
+
+    async def current_user(self):
+        return await self._request("GET", "me")
+
+    async def user_playlist_create(self, user, name, public=False, collaborative=False, description=""):
+        return await self._request("POST", f"users/{user}/playlists", payload={
+            "name": name, "public": public, "collaborative": collaborative, "description": description})
+
+    async def playlist_add_items(self, playlist_id, items):
+        uris = [f"spotify:track:{i}" for i in items]
+        return await self._request("POST", f"playlists/{playlist_id}/tracks", payload={"uris": uris})
+
+    async def all_items(self, path, limit):
+        """Every item of a paged listing. The first page gives the total; the rest are fetched concurrently."""
+        first = await self._request("GET", path, {"limit": limit, "offset": 0})
+        semaphore = asyncio.Semaphore(PAGE_CONCURRENCY)
+
+        async def page(offset):
+            async with semaphore:
+                return await self._request("GET", path, {"limit": limit, "offset": offset})
+
+        rest = await asyncio.gather(*(page(offset) for offset in range(limit, first["total"], limit)))
+        items = list(first["items"])
+        for p in rest:
+            items.extend(p["items"])
+        return items
+
+async def asearch_track(api, track, artist):
+    key = cache.entity_cache.key('track', track, artist)
+    found = cache.entity_cache.get(key)
+    if found is cache.MISSING:
+        query = f"track:{track} artist:{artist}"
+        results = await flights.ado('search', ('track', query), lambda: api.search(query, 'track', limit=5))
+        found = None
+        if results['tracks']['items'] != []:
+            item = results['tracks']['items'][0]
+            found = item['id'], item['album']['artists'][0]['name'], item['name']
+        cache.entity_cache.set(key, found)
+    return tuple(found) if found else None
+
+async def asearch_album(api, album, artist):
+    key = cache.entity_cache.key('album', album, artist)
+    album_id = cache.entity_cache.get(key)
+    if album_id is cache.MISSING:
+        query = f"album:{album} artist:{artist}"
+        results = await flights.ado('search', ('album', query), lambda: api.search(query, 'album', limit=2))
+        album_id = results['albums']['items'][0]['id'] if results['albums']['items'] else None
+        cache.entity_cache.set(key, album_id)
+    return album_id
+
+async def asearch_artist(api, artist):
+    key = cache.entity_cache.key('artist', artist, '')
+    artist_id = cache.entity_cache.get(key)
+    if artist_id is cache.MISSING:
+        query = f"artist:{artist}"
+        results = await flights.ado('search', ('artist', query), lambda: api.search(query, 'artist', limit=3))
+        artist_id = results['artists']['items'][0]['id'] if results['artists']['total'] != 0 else None
+        cache.entity_cache.set(key, artist_id)
+    return artist_id
+
+async def acreate_track_list(api, args, max_workers=SEARCH_MAX_WORKERS, timeout=SEARCH_TIMEOUT, entities=None):
+    """Same contract as utils.create_track_list."""
+    rec_list = args['tracks']
+    semaphore = asyncio.Semaphore(max_workers)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout   # for the whole list, like create_track_list
+
+    async def search(rec):
+        async with semaphore:
+            return await asearch_track(api, rec['track_name'], rec['artist'])
+
+    async def resolve(rec):
+        found = utils.known_track(rec, entities)
+        if found:
+            return found
+        try:
+            return await asyncio.wait_for(search(rec), max(0, deadline - loop.time()))
+        except Exception as e:
+            log.warning("Search failed for %s by %s: %r", rec['track_name'], rec['artist'], e)
+            return None
+
+    tracks_to_add, track_ids_to_add, unresolved = [], [], []
+    for rec, found in zip(rec_list, await asyncio.gather(*(resolve(rec) for rec in rec_list))):
+        if found is None:
+            unresolved.append(rec)
+        else:
+            tracks_to_add.append(found)
+            track_ids_to_add.append(found[0])
+    return track_ids_to_add, tracks_to_add, unresolved
+
+def _listing(items):
+    track_list = [(r['name'], r['id']) for r in items]
+    return ''.join(name + '  \n' for name, track_id in track_list), track_list
+
+async def atop_tracks(api, artist):
+    artist_id = await asearch_artist(api, artist['artist_name'])
+    if not artist_id:
+        log.info("Can't find artist id for %s", artist['artist_name'])
+        return '', []
+    results = await flights.ado('artist_top_tracks', artist_id, lambda: api.artist_top_tracks(artist_id))
+    return _listing(results['tracks'])
+
+async def aalbum_tracks(api, args):
+    album_id = await asearch_album(api, args['album'][0]['album_name'], args['album'][0]['artist'])
+    if not album_id:
+        return '', []
+    return _listing(await flights.ado('album_tracks', album_id, lambda: api.all_items(f"albums/{album_id}/tracks", 50)))
+
+async def aplaylist_track_items(api, playlist_id):
+    items = await api.all_items(f"playlists/{playlist_id}/tracks", 100)
+    return [r['track'] for r in items if r.get('track') and r['track'].get('id')]
+
+async def aplaylist_tracks(api, playlist, user_playlists):
+    match = match_playlist(user_playlists, playlist['playlist_name'])
+    if not match:
+        return '', []
+    # a playlist mixes artists, so each track keeps its own for EntityMemory
+    track_list = [(r['name'], r['id'], utils.track_artist(r)) for r in await aplaylist_track_items(api, match[1])]
+    return ''.join(name + '  \n' for name, track_id, artist in track_list), track_list
+
+async def aget_playlists(api):
+    playlist_list = [(p['name'], p['id']) for p in await api.all_items("me/playlists", 50)]
+    return ''.join(name + '  \n' for name, pid in playlist_list), playlist_list
+
+async def aadd_items_to_playlist(api, args, entities=None):
+    # the searches don't depend on the profile (for a new playlist) or the playlist list (for an existing one)
+    playlist_name = args['playlist_name']
+    if args['new_flag']:
+        (track_ids_to_add, tracks_to_add, unresolved), user_profile = await asyncio.gather(
+            acreate_track_list(api, args, entities=entities), api.current_user())
+        playlist = await api.user_playlist_create(user_profile['id'], playlist_name, public=False, collaborative=False, description='My new playlist')
+        pid = playlist['id']
+        existing_tracks_set = set()
+    else:
+        (track_ids_to_add, tracks_to_add, unresolved), (playlist_string, playlist_list) = await asyncio.gather(
+            acreate_track_list(api, args, entities=entities), aget_playlists(api))
+        match = match_playlist(playlist_list, playlist_name, WRITE_THRESHOLD)
+        if not match:
+            return False
+        pid = match[1]
+        existing_tracks_set = set(t['id'] for t in await aplaylist_track_items(api, pid))
+
+    delta_tracks = []
+    for track_id in track_ids_to_add:
+        if track_id not in existing_tracks_set:
+            existing_tracks_set.add(track_id)
+            delta_tracks.append(track_id)
+    if delta_tracks == []:
+        return False
+    for chunk in chunked(delta_tracks, PLAYLIST_WRITE_CHUNK):   # in order, so the playlist keeps it
+        await api.playlist_add_items(pid, chunk)
+    return True
+
+# sync facade
+
+_loop = None
+_client = None
+_loop_lock = threading.Lock()
+
+def _run(coro):
+    """Run coro on the shared background event loop and wait for the result."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="async-spotify", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result()
+
+async def _with_api(trace_id, token, func, *args):
+    global _client
+    telemetry.set_trace(trace_id)   # the task runs in the loop thread's context, not the caller's
+    if _client is None:   # created on the loop so it belongs to it
+        _client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=50, max_keepalive_connections=20))
+    return await func(AsyncSpotify(_client, token, transport.get_shared_session().bucket), *args)
+
+def _call(sp, func, *args):
+    # the token is read on the caller's thread, where the auth manager's cache handler works
+    token = sp.auth_manager.get_access_token(as_dict=False)
+    return _run(_with_api(telemetry.current_trace(), token, func, *args))
+
+def create_track_list(sp, args, entities=None):
+    return _call(sp, acreate_track_list, args, SEARCH_MAX_WORKERS, SEARCH_TIMEOUT, entities)
+
+def top_tracks(sp, artist):
+    return _call(sp, atop_tracks, artist)
+
+def album_tracks(sp, args):
+    return _call(sp, aalbum_tracks, args)
+
+# with a library mirror the playlist helpers are local reads, and its updates live in utils.py
+
+def playlist_tracks(sp, playlist, user_playlists):
+    if utils.library is not None:
+        return utils.playlist_tracks(sp, playlist, user_playlists)
+    return _call(sp, aplaylist_tracks, playlist, user_playlists)
+
+def get_playlists(sp):
+    if utils.library is not None:
+        return utils.get_playlists(sp)
+    return _call(sp, aget_playlists)
+
+def add_items_to_playlist(sp, args, entities=None):
+    if utils.library is not None:
+        return utils.add_items_to_playlist(sp, args, entities)
+    return _call(sp, aadd_items_to_playlist, args, entities)
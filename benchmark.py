@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks for the Spotify helpers in utils.py.
+
+The helpers run against FakeSpotify, an in-process stand-in for spotipy's
+Spotify client. It records every call, pages its results like the Web API,
+and can add latency to each call and answer every Nth call with a 429. With
+429s, every call is sent through a transport.RateLimitedSession over
+FakeAdapter, so the real retry code waits them out; a 429 it gives up on
+raises SpotifyException, as spotipy does.
+
+    python benchmark.py --out results.json
+    python benchmark.py --latency 0.02 --out new.json --compare results.json
+
+Each helper is run across a range of input sizes. Wall time, Spotify calls
+(by method) and peak memory allocated are reported and written as JSON, and
+--compare flags results that got slower or made more calls than a saved run.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import platform
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+import requests
+from requests.adapters import BaseAdapter
+from spotipy.exceptions import SpotifyException
+
+import cache
+import playlist_index
+import transport
+import utils
+from ratelimit import TokenBucket
+
+TRACK_SIZES = [1, 10, 50, 100, 500]
+PLAYLIST_SIZES = [10, 100, 1000, 5000]
+QUEUE_SIZES = [1, 10, 50]
+
+FAKE_API = 'https://api.spotify.test/v1/'
+
+class FakeAdapter(BaseAdapter):
+    """Answers the requests a FakeSpotify sends through its session, without a network."""
+    def __init__(self, fake):
+        super().__init__()
+        self.fake = fake
+
+    def send(self, request, **kwargs):
+        limited = self.fake._count(request.url.rsplit('/', 1)[-1])
+        response = requests.Response()
+        response.status_code = 429 if limited else 200
+        response.headers['Retry-After'] = str(self.fake.retry_after)
+        response._content = b'{}'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+class FakeSpotify:
+    def __init__(self, playlists=10, playlist_tracks=100, queue=10, latency=0.0, rate_limit_every=0, retry_after=0.01, session=None):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self._requests = 0
+        self._lock = threading.Lock()
+        self.session = session
+        if self.session is None and rate_limit_every:
+            # a bucket that never holds calls back, so only the 429s cost time
+            self.session = transport.RateLimitedSession(TokenBucket(rate=100000, capacity=100000))
+        if self.session is not None:
+            self.session.mount(FAKE_API, FakeAdapter(self))
+        self.playlists = [{'name': f'Playlist {i}', 'id': f'pl{i}', 'snapshot_id': 'snap0'} for i in range(playlists)]
+        self.tracks = {}
+        self.playlist_size = playlist_tracks
+        self.queue_items = [self._track(f'q{i}') for i in range(queue)]
+        self.current = {'is_playing': True, 'progress_ms': 1000, 'item': self._track('now')}
+
+    def _count(self, name):
+        """Record one request; True when it is answered with a 429."""
+        with self._lock:
+            self.calls[name] += 1
+            self._requests += 1
+            limited = bool(self.rate_limit_every) and self._requests % self.rate_limit_every == 0
+            if limited:
+                self.calls['429'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return limited
+
+    def _call(self, name):
+        if self.session is None:
+            self._count(name)
+            return
+        # each retry of a 429 is one more request, and one more call
+        response = self.session.request('GET', FAKE_API + name)
+        if response.status_code == 429:   # the transport gave up
+            raise SpotifyException(429, -1, f"{name}: too many requests", headers=dict(response.headers))
+
+    @staticmethod
+    def _track(track_id, name=None):
+        return {'id': track_id, 'name': name or f'Track {track_id}', 'uri': f'spotify:track:{track_id}',
+                'artists': [{'name': 'Artist'}], 'album': {'artists': [{'name': 'Artist'}]}}
+
+    def _page(self, source, items, offset, limit):
+        more = offset + limit < len(items)
+        return {'items': items[offset:offset + limit], 'total': len(items), 'offset': offset, 'limit': limit,
+                'next': (source, offset + limit, limit) if more else None}
+
+    def _items(self, source):
+        if source == 'playlists':
+            return self.playlists
+        if source not in self.tracks:
+            self.tracks[source] = [{'track': self._track(f'{source}-t{i}')} for i in range(self.playlist_size)]
+        return self.tracks[source]
+
+    # the spotipy methods utils.py uses
+
+    def next(self, page):
+        self._call('next')
+        source, offset, limit = page['next']
+        return self._page(source, self._items(source), offset, limit)
+
+    def search(self, q, type='track', limit=10):
+        self._call('search')
+        key = type + 's'
+        if type == 'track':
+            return {key: {'total': 1, 'items': [self._track(f'id-{abs(hash(q))}', q)]}}
+        return {key: {'total': 1, 'items': [{'id': f'{type}-{abs(hash(q))}', 'name': q}]}}
+
+    def artist_top_tracks(self, artist_id):
+        self._call('artist_top_tracks')
+        return {'tracks': [self._track(f'{artist_id}-{i}') for i in range(10)]}
+
+    def album_tracks(self, album_id, limit=50, offset=0):
+        self._call('album_tracks')
+        return self._page(album_id, [self._track(f'{album_id}-{i}') for i in range(12)], offset, limit)
+
+    def current_user_playlists(self, limit=50, offset=0):
+        self._call('current_user_playlists')
+        return self._page('playlists', self.playlists, offset, limit)
+
+    def playlist_tracks(self, playlist_id, limit=100, offset=0):
+        self._call('playlist_tracks')
+        return self._page(playlist_id, self._items(playlist_id), offset, limit)
+
+    def current_user(self):
+        self._call('current_user')
+        return {'id': 'bench-user'}
+
+    def user_playlist_create(self, user, name, public=False, collaborative=False, description=''):
+        self._call('user_playlist_create')
+        playlist = {'name': name, 'id': f'pl{len(self.playlists)}', 'snapshot_id': 'snap0'}
+        self.playlists.append(playlist)
+        return playlist
+
+    def playlist_add_items(self, playlist_id, items, position=None):
+        self._call('playlist_add_items')
+        if len(items) > 100:
+            raise ValueError("Spotify accepts at most 100 items per request")
+        self._items(playlist_id).extend({'track': self._track(i)} for i in items)
+        # like Spotify, every change gives the playlist a new snapshot_id
+        snapshot_id = f'snap{len(self._items(playlist_id))}'
+        for playlist in self.playlists:
+            if playlist['id'] == playlist_id:
+                playlist['snapshot_id'] = snapshot_id
+        return {'snapshot_id': snapshot_id}
+
+    def devices(self):
+        self._call('devices')
+        return {'devices': [{'id': 'dev', 'is_active': True}]}
+
+    def currently_playing(self):
+        self._call('currently_playing')
+        return self.current
+
+    def queue(self):
+        self._call('queue')
+        return {'currently_playing': self.current['item'], 'queue': list(self.queue_items)}
+
+    def add_to_queue(self, uri, device_id=None):
+        self._call('add_to_queue')
+        self.queue_items.append(self._track(uri))
+
+    def next_track(self, device_id=None):
+        self._call('next_track')
+        if self.queue_items:
+            self.current = dict(self.current, item=self.queue_items.pop(0))
+
+    def start_playback(self, device_id=None, context_uri=None, uris=None, offset=None, position_ms=None):
+        # like Spotify, a new context or list of URIs keeps what the user queued
+        self._call('start_playback')
+        if uris:
+            self.current = dict(self.current, item=self._track(uris[0].rsplit(':', 1)[-1]))
+
+    def pause_playback(self, device_id=None):
+        self._call('pause_playback')
+
+def _tracks_args(n):
+    return {'tracks': [{'track_name': f'Song {i}', 'artist': f'Artist {i % 7}'} for i in range(n)]}
+
+def _reset_caches():
+    cache.entity_cache.clear()
+    playlist_index._indexes.clear()
+
+def measure(name, size, sp, func):
+    """Run func() once with cold caches and return its measurements."""
+    _reset_caches()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    seconds = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    calls = sum(count for method, count in sp.calls.items() if method != '429')
+    return {'benchmark': name, 'size': size, 'seconds': seconds, 'calls': calls,
+            'calls_by_method': dict(sp.calls), 'peak_kb': peak / 1024}
+
+def run_all(latency=0.0, rate_limit_every=0):
+    fake = lambda **kwargs: FakeSpotify(latency=latency, rate_limit_every=rate_limit_every, **kwargs)
+    results = []
+    for n in TRACK_SIZES:
+        sp = fake()
+        results.append(measure('create_track_list', n, sp, lambda: utils.create_track_list(sp, _tracks_args(n))))
+    for n in TRACK_SIZES:
+        sp = fake(playlists=20, playlist_tracks=n)
+        args = dict(_tracks_args(n), playlist_name='Playlist 3', new_flag=False)
+        results.append(measure('add_items_to_playlist', n, sp, lambda: utils.add_items_to_playlist(sp, args)))
+    for n in TRACK_SIZES:
+        sp = fake(playlists=20, playlist_tracks=n)
+        results.append(measure('playlist_tracks', n, sp, lambda: utils.playlist_tracks(sp, {'playlist_name': 'Playlist 3'}, utils.get_playlists(sp)[1])))
+    for n in PLAYLIST_SIZES:
+        sp = fake(playlists=n)
+        results.append(measure('get_playlists', n, sp, lambda: utils.get_playlists(sp)))
+    for strategy in utils.QUEUE_RESET_STRATEGIES:
+        for n in QUEUE_SIZES:
+            sp = fake(queue=n)
+            results.append(measure(f'clear_queue[{strategy}]', n, sp, lambda: utils.clear_queue(sp, strategy)))
+    return results
+
+def compare(results, baseline, tolerance=0.2):
+    """Lines describing results that are slower or make more calls than baseline."""
+    old = {(r['benchmark'], r['size']): r for r in baseline['results']}
+    lines = []
+    for r in results:
+        before = old.get((r['benchmark'], r['size']))
+        if before is None:
+            continue
+        if r['calls'] > before['calls']:
+            lines.append(f"{r['benchmark']} n={r['size']}: {before['calls']} -> {r['calls']} calls")
+        if r['seconds'] > before['seconds'] * (1 + tolerance) and r['seconds'] - before['seconds'] > 0.001:
+            lines.append(f"{r['benchmark']} n={r['size']}: {before['seconds']*1000:.1f} -> {r['seconds']*1000:.1f} ms")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake Spotify call')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='answer every Nth call with a 429')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = run_all(args.latency, args.rate_limit_every)
+    print(f"{'benchmark':<24}{'size':>6}{'ms':>10}{'calls':>8}{'peak KB':>10}")
+    for r in results:
+        print(f"{r['benchmark']:<24}{r['size']:>6}{r['seconds']*1000:>10.1f}{r['calls']:>8}{r['peak_kb']:>10.0f}")
+
+    report = {'meta': {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                       'latency': args.latency, 'rate_limit_every': args.rate_limit_every},
+              'results': results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        print('\n'.join(regressions) if regressions else 'No regressions.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Caches used in front of the Spotify search calls and the model.
+
+An EntityCache has an in-memory LRU tier and an optional SQLite tier. Entries
+expire after a TTL and the oldest entries are evicted once a tier is full.
+Misses (searches that found nothing) are cached too, with a shorter TTL.
+A ResponseCache uses the same tiers for answers to general music questions.
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+MISSING = object()   # returned by get() when there is no usable entry
+
+class MemoryBackend:
+    """Thread-safe LRU dict of key -> (expires_at, value)."""
+
+    def __init__(self, max_size=5000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SQLiteBackend:
+    """On-disk tier. Values must be JSON serialisable."""
+
+    def __init__(self, path, max_size=100000):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL, accessed_at REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return MISSING
+            if row[1] < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return MISSING
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, json.dumps(value), now + ttl, now))
+            self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+            count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.max_size:
+                self._conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)", (count - self.max_size,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+class TieredCache:
+    """Memory tier in front of an optional disk tier, with hit/miss counters.
+
+    A value of None is treated as a cached miss and kept for negative_ttl
+    seconds instead of ttl.
+    """
+
+    def __init__(self, memory=None, disk=None, ttl=24*3600, negative_ttl=3600):
+        self.memory = memory if memory is not None else MemoryBackend()
+        self.disk = disk
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'negative_hits': 0, 'disk_hits': 0, 'misses': 0, 'sets': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is MISSING and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not MISSING:
+                self._count('disk_hits')
+                self.memory.set(key, value, self.negative_ttl if value is None else self.ttl)
+        if value is MISSING:
+            self._count('misses')
+        else:
+            self._count('negative_hits' if value is None else 'hits')
+        return value
+
+    def set(self, key, value):
+        ttl = self.negative_ttl if value is None else self.ttl
+        self.memory.set(key, value, ttl)
+        if self.disk is not None:
+            self.disk.set(key, value, ttl)
+        self._count('sets')
+
+    def get_or_fetch(self, key, fetch):
+        """Return the cached value for key, calling fetch() on a miss."""
+        value = self.get(key)
+        if value is MISSING:
+            value = fetch()
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['negative_hits'] + self.stats['misses']
+        return (self.stats['hits'] + self.stats['negative_hits']) / lookups if lookups else 0.0
+
+def normalize(text):
+    """Case, accent and punctuation insensitive form of a name."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+class EntityCache(TieredCache):
+    """Cache of Spotify search results keyed on (type, name, artist)."""
+
+    def key(self, entity_type, name, artist=''):
+        return f"{entity_type}|{normalize(name)}|{normalize(artist)}"
+
+    def lookup(self, entity_type, name, artist, fetch):
+        return self.get_or_fetch(self.key(entity_type, name, artist), fetch)
+
+def make_entity_cache(path=None, max_size=5000, ttl=24*3600, negative_ttl=3600):
+    """Build an EntityCache, with an SQLite tier when a path is given."""
+    disk = SQLiteBackend(path) if path else None
+    return EntityCache(MemoryBackend(max_size), disk, ttl=ttl, negative_ttl=negative_ttl)
+
+class ResponseCache(TieredCache):
+    """Cache of model answers that did not call a tool.
+
+    Keyed on the normalized last prompt plus a hash of the rest of the
+    conversation, the model and the temperature, so an answer is only reused
+    for the same question asked in the same context.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats['seconds_saved'] = 0.0
+
+    def key(self, messages, model, temperature):
+        context = json.dumps(messages[:-1], sort_keys=True)
+        digest = hashlib.sha256(f"{model}|{temperature}|{context}".encode()).hexdigest()
+        return f"response|{digest}|{normalize(messages[-1]['content'])}"
+
+    def lookup(self, key):
+        """The cached answer text for a key(), or None."""
+        value = self.get(key)
+        if value is MISSING or value is None:
+            return None
+        with self._lock:
+            self.stats['seconds_saved'] += value['seconds']
+        return value['text']
+
+    def store(self, key, text, seconds):
+        """Remember an answer under a key() and how long the model took to produce it."""
+        self.set(key, {'text': text, 'seconds': seconds})
+
+def make_response_cache(path=None, max_size=1000, ttl=7*24*3600):
+    """Build a ResponseCache, with an SQLite tier when a path is given."""
+    disk = SQLiteBackend(path) if path else None
+    return ResponseCache(MemoryBackend(max_size), disk, ttl=ttl)
+
+# Shared by every session in the process. spotify.py may replace it with one
+# that has an on-disk tier (see the [cache] section of config.toml).
+entity_cache = make_entity_cache()
+
+# Off unless [response_cache] enabled is set in config.toml.
+response_cache = None
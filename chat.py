@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+One chat turn, independent of the UI.
+
+run_turn() takes a prompt through the fast path or the model, runs the
+function calls the model asks for and records everything in the
+conversation. What the user sees goes through a View: spotify.py draws it
+with Streamlit, server.py collects it for a JSON reply.
+"""
+
+import time
+
+from spotipy.cache_handler import MemoryCacheHandler
+from spotipy.oauth2 import SpotifyOAuth
+
+import cache
+import playback
+import telemetry
+import tokens
+import transport
+import utils
+from context import compact_messages
+from intents import fast_path
+from registry import registry, use_backend
+from singleflight import flights
+from tool_selector import full_set, select_tools
+from utils import GPT_MODEL, TEMPERATURE, chat_request, chat_request_stream, prefetch_tool, extract_response_details, extract_function_calls, function_call_items
+
+log = telemetry.get_logger('chat')
+
+background ="The user wants to control Spotify.\
+            Use the tools functions provided to get information from Spotify or take actions in Spotify. If the user asks you to take actions in Spotify, \
+            such as pause or start playback, do not just reply that you took the action--you should use the tools functions. If you are not certain what to do, or if you \
+            don't have all information needed to call a tools function, ask the user for clarification or more details. If the user asks general questions about music then answer those concisely. But don't\
+            answer questions that are not related to music."
+
+def new_conversation():
+    return [{"role": "system", "content": background}]
+
+def setup(config):
+    """Process-wide setup from config.toml, for every entry point. Returns the TokenStore, or None."""
+    telemetry.configure(**config["telemetry"])
+    if config["cache"]["path"] and cache.entity_cache.disk is None:
+        cache.entity_cache = cache.make_entity_cache(**config["cache"])
+    playback.PLAYBACK_TTL = config["playback"]["ttl"]
+    flights.enabled = config["singleflight"]["enabled"]
+    if config["chatbot"]["async_backend"]:
+        import async_utils
+        use_backend(async_utils)
+    if config["response_cache"]["enabled"] and cache.response_cache is None:
+        cache.response_cache = cache.make_response_cache(config["response_cache"]["path"], config["response_cache"]["max_size"], config["response_cache"]["ttl"])
+    if config["library"]["enabled"] and utils.library is None:
+        from library import LibraryMirror
+        utils.library = LibraryMirror(config["library"]["path"], config["library"]["ttl"])
+    token_store = None
+    if config["token_store"]["enabled"]:
+        # logins survive new browser sessions, and tokens are renewed off the request path
+        token_store = tokens.get_token_store(**config["token_store"])
+        tokens.start_refresher(token_store,
+                               lambda refresh_token: SpotifyOAuth(**config["spotipy"], cache_handler=MemoryCacheHandler()).refresh_access_token(refresh_token),
+                               config["token_store"]["refresh_margin"], config["token_store"]["refresh_interval"],
+                               config["token_store"]["retention"])
+    telemetry.collect("entity_cache", lambda: cache.entity_cache.stats)
+    telemetry.collect("transport", transport.metrics)
+    telemetry.collect("singleflight", lambda: flights.stats)
+    if utils.library is not None:
+        telemetry.collect("library", lambda: utils.library.stats)
+    if cache.response_cache:
+        telemetry.collect("response_cache", lambda: cache.response_cache.stats)
+    return token_store
+
+class View:
+    """How a turn is shown. This one shows nothing; subclasses override what they need."""
+
+    def text(self, content):
+        """A complete system message."""
+
+    def stream(self, response):
+        """Show a StreamingResponse as it arrives and return its text."""
+        for delta in response.text_deltas():
+            pass
+        return response.text
+
+    def context(self, report):
+        """The compact_messages() report for the prompt sent to the model."""
+
+    def queue_progress(self, rec, found):
+        """One track of an add_to_queue call is done."""
+
+    def queue_done(self):
+        pass
+
+    def result(self, call, result):
+        """A ToolResult, after it has been recorded in the conversation."""
+
+def _say(messages, view, content):
+    messages.append({"role": "system", "content": content})
+    view.text(content)
+
+UNREACHABLE = "Sorry, I couldn't reach OpenAI. Please try again."
+
+def _read_stream(view, response):
+    """view.stream(response), or None when the stream broke off (e.g. a dropped connection)."""
+    try:
+        return view.stream(response)
+    except Exception as e:
+        log.warning("OpenAI stream failed: %r", e)
+        telemetry.incr('llm_errors_total')
+        return None
+
+def record_result(messages, result):
+    """Add a ToolResult to the conversation, or start a new one for reset."""
+    if result.reset:
+        messages[:] = new_conversation()
+    elif result.items:
+        messages.append({"role": "system", "content": result.history})
+    elif result.message:
+        messages.append({"role": "system", "content": result.message})
+
+RECENT_TOOLS = 10   # tool calls remembered for tool selection
+
+def run_turn(sp, openai_client, messages, prompt, settings, entities=None, view=None, recent_tools=None):
+    """Answer one prompt. messages is the conversation and is updated in place;
+    settings is the [chatbot] section of config.toml. recent_tools is a list of
+    the session's latest tool names, also updated in place. Returns [(call, ToolResult)]."""
+    view = view or View()
+    messages.append({"role": "user", "content": prompt})
+    request_messages = None
+
+    # simple commands like "pause" or "clear the queue" don't need the model
+    intent = fast_path(prompt, settings["intent_threshold"]) if settings["fast_path"] else None
+    if intent:
+        log.info("fast path: %s", intent['name'])
+        telemetry.incr('fast_path_total', intent=intent['name'])
+        function_calls = [intent]
+    else:
+        # send a compacted copy of the history; the full one stays in messages
+        request_messages, context_report = compact_messages(messages, budget=settings["token_budget"], keep_recent=settings["keep_recent"])
+        log.debug("prompt tokens: %s", context_report)
+        view.context(context_report)
+
+        # only the tool schemas this prompt could need
+        if settings["tool_selection"]:
+            tools, schema_tokens, groups = select_tools(prompt, recent_tools or ())
+        else:
+            (tools, schema_tokens), groups = full_set(), None
+        log.debug("tools: %s (%d tokens)", groups or 'all', schema_tokens)
+        telemetry.incr('tool_selection_total', choice='subset' if groups else 'all')
+        telemetry.incr('llm_tool_schema_tokens_total', schema_tokens)
+        telemetry.incr('llm_tool_schema_tokens_saved_total', full_set()[1] - schema_tokens)
+
+        # the key is taken now: the answer is appended to the conversation before it is stored
+        cache_key = cache.response_cache.key(request_messages, GPT_MODEL, TEMPERATURE) if cache.response_cache else None
+        cached_text = cache.response_cache.lookup(cache_key) if cache_key else None
+        request_start = time.perf_counter()
+        if cached_text:
+            # the same question was answered in the same context before
+            _say(messages, view, cached_text)
+            telemetry.incr('response_cache_hits_total')
+            response_text, function_calls = None, []
+        elif settings["stream"]:
+            # show the text as it arrives and start the searches a tool call needs as soon as its arguments are complete
+            response = chat_request_stream(openai_client, request_messages, tools=tools, tool_choice="auto",
+                                           on_function_call=lambda name, args: prefetch_tool(sp, name, args, entities))
+            text = None if isinstance(response, Exception) else _read_stream(view, response)
+            if text is None and (isinstance(response, Exception) or response.response is None):
+                # never started, or broke off before the end: don't act on half a response
+                _say(messages, view, UNREACHABLE)
+                response_text, function_calls = None, []
+            else:
+                response_text = text or None
+                if response_text:
+                    messages.append({"role": "system", "content": response_text})
+                function_calls = response.function_calls
+        else:
+            response = chat_request(openai_client, request_messages, tools=tools, tool_choice="auto")
+            response_text, function_name, function_args = extract_response_details(response)
+            function_calls = extract_function_calls(response)
+            if response_text != None:
+                _say(messages, view, response_text)
+
+        # only plain answers are reused, never ones that acted on Spotify
+        if cache.response_cache and response_text and not function_calls:
+            cache.response_cache.store(cache_key, response_text, time.perf_counter() - request_start)
+
+    log.info("function calls: %s", [call['name'] for call in function_calls])
+    if not function_calls:
+        # Nothing to do. Go back and get clarification
+        return []
+
+    results = registry.run(sp, function_calls, {"queue_progress": view.queue_progress, "entities": entities})
+    if recent_tools is not None:
+        recent_tools.extend(call['name'] for call in function_calls)
+        del recent_tools[:-RECENT_TOOLS]
+    view.queue_done()
+    with telemetry.span('render'):
+        for call, result in results:
+            record_result(messages, result)
+            view.result(call, result)
+
+    if len(results) > 1 and request_messages is not None and not any(result.reset for call, result in results):
+        # several calls at once: let the model sum up all the results in one more request
+        followup_messages = request_messages + function_call_items(results)
+        if settings["stream"]:
+            response = chat_request_stream(openai_client, followup_messages, tools=tools, tool_choice="none")
+            text = None if isinstance(response, Exception) else _read_stream(view, response)
+            if text:
+                messages.append({"role": "system", "content": text})
+            elif isinstance(response, Exception) or response.response is None:
+                _say(messages, view, UNREACHABLE)
+        else:
+            response = chat_request(openai_client, followup_messages, tools=tools, tool_choice="none")
+            response_text, function_name, function_args = extract_response_details(response)
+            if response_text != None:
+                _say(messages, view, response_text)
+
+    log.debug("entity cache hit rate %.0f%%, spotify transport: %s", cache.entity_cache.hit_rate() * 100, transport.metrics())
+    return results
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keeps the conversation sent to OpenAI inside a token budget.
+
+The full history stays in st.session_state.messages for display; only the
+copy sent with each request is compacted. The system prompt and the most
+recent messages are kept verbatim, older track and playlist listings are
+collapsed to a short summary that keeps the first few names and every
+Spotify ID, and if that is still not enough the oldest messages are dropped.
+"""
+
+try:
+    import tiktoken
+except ImportError:   # fall back to a rough estimate
+    tiktoken = None
+
+import re
+
+TOKEN_BUDGET = 4000   # prompt tokens allowed for the conversation
+KEEP_RECENT = 6       # messages always sent verbatim (besides the system prompt)
+SUMMARY_ITEMS = 10    # names kept from a compacted listing; the rest keep only their IDs
+
+# the prefixes registry.py uses when it records a Spotify listing in the history
+DUMP_PREFIXES = ("These are the tracks", "These are your current playlists")
+LINK = re.compile(r'^\[(.*)\]\(spotify:(\w+):(\w+)\)$')   # one listed item, as registry.listing_history writes it
+
+_encoding = None
+
+def count_tokens(messages):
+    """Approximate prompt tokens for a list of {'role', 'content'} messages."""
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    total = 0
+    for msg in messages:
+        content = msg.get("content") or ""
+        total += 4 + (len(_encoding.encode(content)) if _encoding else len(content) // 4)
+    return total
+
+def is_dump(msg):
+    return msg.get("content", "").startswith(DUMP_PREFIXES)
+
+def summarize_dump(msg):
+    """Collapse a listing to its heading, item count, first few names and the IDs of the rest."""
+    heading, _, body = msg["content"].partition(":")
+    lines = [line.strip() for line in body.split("\n") if line.strip()]
+    summary = ", ".join(lines[:SUMMARY_ITEMS])
+    rest = lines[SUMMARY_ITEMS:]
+    if rest:
+        links = [LINK.match(line) for line in rest]
+        if all(links):   # "add those to the queue" can still name every one of them
+            summary += f" and {len(rest)} more, by {links[0].group(2)} ID: " + ", ".join(link.group(3) for link in links)
+        else:
+            summary += f" and {len(rest)} more"
+    return {"role": msg["role"], "content": f"{heading} ({len(lines)} in total): {summary}"}
+
+def compact_messages(messages, budget=TOKEN_BUDGET, keep_recent=KEEP_RECENT):
+    """Return (compacted messages, report). report has the prompt tokens before and after."""
+    before = count_tokens(messages)
+    if before <= budget:
+        # a copy: the caller keeps appending to messages while the request is in use
+        return list(messages), {"before": before, "after": before, "dropped": 0}
+
+    system, history = messages[:1], messages[1:]
+    split = max(0, len(history) - keep_recent)
+    old = [summarize_dump(m) if is_dump(m) else m for m in history[:split]]
+    recent = history[split:]
+
+    dropped = 0
+    while old and count_tokens(system + old + recent) > budget:
+        old.pop(0)
+        dropped += 1
+    if count_tokens(system + old + recent) > budget:
+        # still too big: compact the recent listings too, except the newest message
+        recent = [summarize_dump(m) if is_dump(m) and i < len(recent) - 1 else m for i, m in enumerate(recent)]
+    if dropped:
+        old.insert(0, {"role": "system", "content": f"({dropped} earlier messages were left out to save space.)"})
+
+    compacted = system + old + recent
+    return compacted, {"before": before, "after": count_tokens(compacted), "dropped": dropped}
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-session memory of the tracks the chatbot has shown.
+
+When the user says "add those to the queue" after a listing, the model sends
+back track names, not IDs. EntityMemory remembers every (name, id) pair the
+session has seen, so those names resolve locally and only tracks that were
+never shown go to Spotify search.
+
+A name matches when it is the same after cache.normalize(), or the same
+once a " - 2017 Remaster" or " (Live)" style suffix is dropped from the
+Spotify name. If the artist of a remembered track is known it has to match
+too. A name that still matches more than one track is left to search.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+from cache import normalize
+
+MAX_ENTITIES = 2000   # remembered tracks per session, oldest dropped first
+
+_SUFFIX = re.compile(r'\s+-\s+.*$|\s*[\(\[].*$')
+
+def _names(name):
+    full = normalize(name)
+    base = normalize(_SUFFIX.sub('', name))
+    return {full, base} if base else {full}
+
+class EntityMemory:
+    def __init__(self, max_size=MAX_ENTITIES):
+        self.max_size = max_size
+        self._tracks = OrderedDict()   # track id -> (name, artist or None)
+        self._by_name = {}             # normalized name -> set of track ids
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def remember(self, items, artist=None):
+        """Record (name, id) pairs shown to the user, e.g. a ToolResult's items, or (name, id, artist)
+        triples. artist applies to the pairs."""
+        with self._lock:
+            for name, track_id, *own in items:
+                track_artist = own[0] if own else artist
+                self._forget(track_id)
+                self._tracks[track_id] = (name, normalize(track_artist) if track_artist else None)
+                for key in _names(name):
+                    self._by_name.setdefault(key, set()).add(track_id)
+            while len(self._tracks) > self.max_size:
+                self._forget(next(iter(self._tracks)))
+
+    def _forget(self, track_id):
+        entry = self._tracks.pop(track_id, None)
+        if entry is None:
+            return
+        for key in _names(entry[0]):
+            ids = self._by_name.get(key)
+            if ids:
+                ids.discard(track_id)
+                if not ids:
+                    del self._by_name[key]
+
+    def resolve(self, track, artist):
+        """The remembered track for a (track_name, artist) rec as a search_track() tuple, or None."""
+        artist_key = normalize(artist)
+        with self._lock:
+            ids = set()
+            for key in _names(track):
+                ids |= self._by_name.get(key, set())
+            # a track remembered without its artist is only taken for a rec without one
+            candidates = [i for i in ids if self._tracks[i][1] == artist_key] if artist_key else list(ids)
+            if len(candidates) > 1:   # e.g. the original and a remaster: take the exact name if there is one
+                candidates = [i for i in candidates if normalize(self._tracks[i][0]) == normalize(track)]
+            if len(candidates) == 1:
+                track_id = candidates[0]
+                self._tracks.move_to_end(track_id)
+                self.stats['hits'] += 1
+                return track_id, artist, self._tracks[track_id][0]
+            self.stats['misses'] += 1
+            return None
+
+    def get(self, track_id):
+        """(name, artist or None) of a remembered track id, or None."""
+        with self._lock:
+            return self._tracks.get(track_id)
+
+    def dump(self):
+        """[name, id, artist] rows, oldest first, for keeping the memory outside the process."""
+        with self._lock:
+            return [[name, track_id, artist] for track_id, (name, artist) in self._tracks.items()]
+
+    @classmethod
+    def load(cls, rows, max_size=MAX_ENTITIES):
+        memory = cls(max_size)
+        for name, track_id, artist in rows:
+            memory.remember([(name, track_id)], artist)
+        return memory
+
+    def clear(self):
+        with self._lock:
+            self._tracks.clear()
+            self._by_name.clear()
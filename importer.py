@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk import of (track, artist) rows from a CSV or JSONL file into a playlist.
+
+    python importer.py tracks.csv --playlist "Deep Neil" --new
+    python importer.py tracks.jsonl --playlist "Deep Neil"      # existing playlist
+
+CSV files need a header with track_name (or track, title, name) and artist
+(or artist_name) columns; JSONL lines are objects with the same keys.
+
+Rows are read lazily and handled a batch at a time: resolved with the same
+concurrent, cached search as create_track_list, deduplicated against the
+playlist, and written in chunks of 100. Only one batch and the playlist's
+track IDs are held in memory. After every batch a checkpoint file is
+written next to the input, so running the same command again after an
+interruption carries on where it stopped. Rows that could not be found are
+appended to <input>.unresolved.jsonl; rows without a track name are
+skipped and counted as blank.
+
+Searches have no overall deadline here: a bulk import can wait for the
+rate limit. If a search fails (as opposed to finding nothing), the import
+stops before that row, so the next run searches it again.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import toml
+from spotipy import Spotify
+from spotipy.oauth2 import SpotifyOAuth
+
+import telemetry
+import transport
+from playlist_index import WRITE_THRESHOLD, match_playlist
+from utils import SEARCH_MAX_WORKERS, chunked, find_track, get_playlists, iter_playlist_tracks
+
+BATCH_SIZE = 200   # rows resolved and written per checkpoint
+
+TRACK_COLUMNS = ('track_name', 'track', 'title', 'name')
+ARTIST_COLUMNS = ('artist', 'artist_name')
+
+def _rec(row):
+    track = next((row[c] for c in TRACK_COLUMNS if row.get(c)), None)
+    artist = next((row[c] for c in ARTIST_COLUMNS if row.get(c)), '')
+    return {'track_name': track.strip(), 'artist': artist.strip()} if track else None
+
+def read_rows(path):
+    """Yield a rec per row of a CSV or JSONL file, None for rows without a track name."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith(('.jsonl', '.json')):
+            for line in f:
+                if line.strip():
+                    yield _rec(json.loads(line))
+        else:
+            for row in csv.DictReader(f):
+                yield _rec({k.strip().lower(): v for k, v in row.items() if k})
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_checkpoint(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)   # never leave a half-written checkpoint
+
+def find_or_create_playlist(sp, name, new):
+    if new:
+        user_id = sp.current_user()['id']
+        return sp.user_playlist_create(user=user_id, name=name, public=False, collaborative=False, description='Imported playlist')['id']
+    playlist_string, playlist_list = get_playlists(sp)
+    match = match_playlist(playlist_list, name, WRITE_THRESHOLD)
+    return match[1] if match else None
+
+def resolve_batch(sp, batch, max_workers=SEARCH_MAX_WORKERS):
+    """[(found, error)] per row of batch, waiting for every search. found is the search_track() tuple or
+    None when nothing was found; error is the exception when the search itself failed."""
+    recs = [rec for rec in batch if rec]
+    if not recs:
+        return [(None, None) for rec in batch]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(recs)))) as executor:
+        futures = iter([executor.submit(telemetry.propagate(find_track), sp, rec) for rec in recs])
+        results = []
+        for rec in batch:
+            future = next(futures) if rec else None
+            if future is None:
+                results.append((None, None))
+            elif future.exception() is not None:
+                results.append((None, future.exception()))
+            else:
+                results.append((future.result(), None))
+    return results
+
+def import_tracks(sp, rows, playlist_id, state, checkpoint_path=None, unresolved_path=None, batch_size=BATCH_SIZE, report=print):
+    """Add the tracks in rows to the playlist, skipping the state['rows_done'] rows already imported.
+    state is updated in place and saved to checkpoint_path after every batch. Stops early, without
+    state['done'], at the first row whose search failed."""
+    existing = set(track_id for track_name, track_id, artist in iter_playlist_tracks(sp, playlist_id))
+    start = time.perf_counter()
+    rows_this_run = 0
+    for batch in chunked(itertools.islice(rows, state['rows_done'], None), batch_size):
+        new_ids, unresolved, duplicates, blank, failed = [], [], 0, 0, None
+        for i, (rec, (found, error)) in enumerate(zip(batch, resolve_batch(sp, batch))):
+            if rec is None:
+                blank += 1
+            elif error is not None:
+                failed = i   # only the rows before it are done
+                report(f"Search failed for {rec['track_name']} by {rec['artist']}: {error!r}")
+                break
+            elif found is None:
+                unresolved.append(rec)
+            elif found[0] in existing:
+                duplicates += 1
+            else:
+                existing.add(found[0])
+                new_ids.append(found[0])
+        done = batch[:failed] if failed is not None else batch
+        for chunk in chunked(new_ids):
+            sp.playlist_add_items(playlist_id=playlist_id, items=chunk)
+
+        if unresolved_path and unresolved:
+            with open(unresolved_path, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(rec) + '\n' for rec in unresolved)
+        state['rows_done'] += len(done)
+        state['added'] += len(new_ids)
+        state['duplicates'] += duplicates
+        state['unresolved'] += len(unresolved)
+        state['blank'] = state.get('blank', 0) + blank   # checkpoints from before blank rows were counted
+        if checkpoint_path:
+            save_checkpoint(checkpoint_path, state)
+
+        rows_this_run += len(done)
+        seconds = time.perf_counter() - start
+        report(f"{state['rows_done']} rows: {state['added']} added, {state['duplicates']} already there, "
+               f"{state['unresolved']} not found, {state['blank']} blank ({rows_this_run / seconds:.1f} tracks/s)")
+        if failed is not None:
+            report("Stopped; run the same command again to carry on from this row.")
+            return state
+    state['done'] = True
+    if checkpoint_path:
+        save_checkpoint(checkpoint_path, state)
+    return state
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('path', help='CSV or JSONL file of tracks')
+    parser.add_argument('--playlist', required=True, help='name of the playlist to add to')
+    parser.add_argument('--new', action='store_true', help='create the playlist')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--restart', action='store_true', help='ignore an earlier checkpoint')
+    args = parser.parse_args()
+
+    config = toml.load("./config.toml")
+    # a command-line login: spotipy keeps the token in its own .cache file
+    sp = Spotify(auth_manager=SpotifyOAuth(**config["spotipy"]), requests_session=transport.get_shared_session(**config["transport"]),
+                 requests_timeout=config["transport"]["timeout"])
+
+    checkpoint_path = args.path + '.checkpoint.json'
+    state = None if args.restart else load_checkpoint(checkpoint_path)
+    if state and state.get('done'):
+        print(f"{args.path} was already imported; use --restart to import it again.")
+        return
+    if state:
+        print(f"Resuming after row {state['rows_done']}.")
+        playlist_id = state['playlist_id']   # a playlist created by the first run isn't created again
+    else:
+        playlist_id = find_or_create_playlist(sp, args.playlist, args.new)
+        if not playlist_id:
+            print(f"Couldn't find a playlist called {args.playlist}.")
+            return
+        state = {'input': args.path, 'playlist_id': playlist_id, 'rows_done': 0, 'added': 0, 'duplicates': 0, 'unresolved': 0, 'blank': 0}
+        save_checkpoint(checkpoint_path, state)
+
+    start = time.perf_counter()
+    state = import_tracks(sp, read_rows(args.path), playlist_id, state, checkpoint_path, args.path + '.unresolved.jsonl', args.batch_size)
+    if state.get('done'):
+        print(f"Done in {time.perf_counter() - start:.1f}s.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Recognises simple playback commands locally, without asking the model.
+
+"pause", "play", "clear the queue" and the like map straight to the tools
+that take no arguments. classify() returns the tool name and a confidence;
+spotify.py only skips the LLM when the confidence is at or above the
+threshold, and everything else goes to chat_request as before.
+"""
+
+import re
+
+from cache import normalize
+
+INTENT_THRESHOLD = 0.8
+
+# words that don't change what a short command means
+FILLER = {'please', 'pls', 'can', 'could', 'would', 'you', 'will', 'just', 'now', 'the', 'my', 'hey', 'ok', 'okay',
+          'spotify', 'music', 'it', 'song', 'track', 'playback', 'playing', 'for', 'me', 'thanks', 'thank', 'again'}
+
+# exact phrases (after normalization and dropping filler words) per tool
+RULES = {
+    'pause': [r'pause', r'pause play', r'stop', r'stop play', r'hold on', r'hold'],
+    'start': [r'start', r'play', r'resume', r'go', r'unpause', r'continue', r'keep going'],
+    'clear_queue': [r'clear (?:out )?queue', r'empty queue', r'clear up queue'],
+    'reset': [r'reset', r'start over', r'clear history', r'clear chat', r'new chat'],
+    'get_playlists': [r'(?:show|list|what are|get) (?:all )?playlists', r'playlists'],
+}
+PATTERNS = {name: [re.compile(f'^{p}$') for p in patterns] for name, patterns in RULES.items()}
+
+# keywords for the fallback scorer: weight given to each word
+KEYWORDS = {
+    'pause': {'pause': 1.0, 'stop': 0.8, 'hold': 0.5},
+    'start': {'start': 0.9, 'resume': 1.0, 'play': 0.7, 'go': 0.6, 'unpause': 1.0, 'continue': 0.8},
+    'clear_queue': {'clear': 0.5, 'empty': 0.5, 'queue': 0.5},
+    'reset': {'reset': 1.0, 'history': 0.4, 'over': 0.3},
+    'get_playlists': {'playlists': 0.9, 'list': 0.2, 'show': 0.1, 'all': 0.1},
+}
+
+def _words(text):
+    return [w for w in normalize(text).split() if w not in FILLER]
+
+def classify(prompt):
+    """Return (tool name, confidence) for a simple command, or (None, 0.0)."""
+    words = _words(prompt)
+    if not words or len(words) > 4:   # longer prompts carry arguments or questions
+        return None, 0.0
+    phrase = ' '.join(words)
+    for name, patterns in PATTERNS.items():
+        if any(p.match(phrase) for p in patterns):
+            return name, 1.0
+
+    # score the remaining short prompts on keywords, penalising words we don't know and words
+    # that belong to another intent ("play my playlists" is neither start nor get_playlists)
+    best, best_score = None, 0.0
+    for name, weights in KEYWORDS.items():
+        score = sum(weights.get(w, 0.0) for w in words)
+        unknown = sum(1 for w in words if not any(w in k for k in KEYWORDS.values()))
+        competing = sum(1 for w in words if w not in weights and any(w in k for k in KEYWORDS.values()))
+        score = min(1.0, score) * (0.5 ** (unknown + competing))
+        if score > best_score:
+            best, best_score = name, score
+    return best, best_score
+
+def fast_path(prompt, threshold=INTENT_THRESHOLD):
+    """The function call to make for prompt without asking the model, or None."""
+    name, confidence = classify(prompt)
+    if name is None or confidence < threshold:
+        return None
+    return {'call_id': None, 'name': name, 'args': {}, 'confidence': confidence}
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local SQLite mirror of each user's playlists and their tracks.
+
+The playlist list is fetched from Spotify at most once per TTL; in between,
+get_playlists() is answered locally. Every playlist carries a snapshot_id
+that changes whenever its contents change, so a playlist's tracks are only
+fetched again when the snapshot in the latest list differs from the one the
+mirror was filled from. Playlists we create or add to are updated in the
+mirror straight away, using the snapshot_id Spotify returns for the write.
+
+utils.py uses the mirror when utils.library is set (see [library] in
+config.toml).
+"""
+
+import sqlite3
+import threading
+import time
+import weakref
+
+from utils import paginate, track_artist
+
+LIBRARY_TTL = 60   # seconds the playlist list is trusted before it is fetched again
+
+class LibraryMirror:
+    def __init__(self, path, ttl=LIBRARY_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._users = weakref.WeakKeyDictionary()   # Spotify client -> user id
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, listed_at REAL);
+            CREATE TABLE IF NOT EXISTS playlists (user_id TEXT, id TEXT, name TEXT, snapshot_id TEXT, position INTEGER,
+                                                  PRIMARY KEY (user_id, id));
+            CREATE TABLE IF NOT EXISTS synced (playlist_id TEXT PRIMARY KEY, snapshot_id TEXT);
+            CREATE TABLE IF NOT EXISTS tracks (playlist_id TEXT, position INTEGER, track_id TEXT, name TEXT, artist TEXT);
+            CREATE INDEX IF NOT EXISTS tracks_playlist ON tracks (playlist_id, position);
+        """)
+        try:   # mirrors from before artists were kept: fetch every playlist's tracks again
+            self._conn.execute("ALTER TABLE tracks ADD COLUMN artist TEXT")
+            self._conn.execute("DELETE FROM synced")
+        except sqlite3.OperationalError:
+            pass
+        self._conn.commit()
+        self.stats = {'list_fetches': 0, 'list_hits': 0, 'track_fetches': 0, 'track_hits': 0}
+
+    def user_id(self, sp):
+        with self._lock:
+            if sp not in self._users:
+                self._users[sp] = sp.current_user()['id']
+            return self._users[sp]
+
+    def refresh_playlists(self, sp):
+        """Fetch the playlist list from Spotify and store it."""
+        user_id = self.user_id(sp)
+        rows = [(user_id, p['id'], p['name'], p.get('snapshot_id'), i)
+                for i, p in enumerate(paginate(sp, sp.current_user_playlists(limit=50)))]
+        with self._lock:
+            self._conn.execute("DELETE FROM playlists WHERE user_id = ?", (user_id,))
+            self._conn.executemany("INSERT INTO playlists VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.execute("INSERT OR REPLACE INTO users VALUES (?, ?)", (user_id, time.time()))
+            self._conn.commit()
+            self.stats['list_fetches'] += 1
+
+    def playlists(self, sp):
+        """[(name, id)] of the user's playlists, in Spotify's order."""
+        user_id = self.user_id(sp)
+        with self._lock:
+            row = self._conn.execute("SELECT listed_at FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            fresh = row is not None and row[0] > time.time() - self.ttl
+            if fresh:
+                self.stats['list_hits'] += 1
+        if not fresh:
+            self.refresh_playlists(sp)
+        with self._lock:
+            return self._conn.execute("SELECT name, id FROM playlists WHERE user_id = ? ORDER BY position", (user_id,)).fetchall()
+
+    def playlist_tracks(self, sp, playlist_id):
+        """[(track_name, track_id, artist)] of a playlist, fetched only when its snapshot changed."""
+        self.playlists(sp)   # makes sure the snapshot ids are recent
+        with self._lock:
+            listed = self._conn.execute("SELECT snapshot_id FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+            synced = self._conn.execute("SELECT snapshot_id FROM synced WHERE playlist_id = ?", (playlist_id,)).fetchone()
+            if listed and synced and listed[0] and listed[0] == synced[0]:
+                self.stats['track_hits'] += 1
+                return self._conn.execute("SELECT name, track_id, artist FROM tracks WHERE playlist_id = ? ORDER BY position",
+                                          (playlist_id,)).fetchall()
+        tracks = [(r['track']['name'], r['track']['id'], track_artist(r['track'])) for r in paginate(sp, sp.playlist_tracks(playlist_id))
+                  if r.get('track') and r['track'].get('id')]
+        with self._lock:
+            self._conn.execute("DELETE FROM tracks WHERE playlist_id = ?", (playlist_id,))
+            self._conn.executemany("INSERT INTO tracks VALUES (?, ?, ?, ?, ?)",
+                                   [(playlist_id, i, track_id, name, artist) for i, (name, track_id, artist) in enumerate(tracks)])
+            self._conn.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)", (playlist_id, listed[0] if listed else None))
+            self._conn.commit()
+            self.stats['track_fetches'] += 1
+        return tracks
+
+    def created(self, sp, playlist):
+        """Record a playlist we just created (the user_playlist_create response); it starts empty."""
+        user_id = self.user_id(sp)
+        with self._lock:
+            position = self._conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM playlists WHERE user_id = ?", (user_id,)).fetchone()[0]
+            self._conn.execute("INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)",
+                               (user_id, playlist['id'], playlist['name'], playlist.get('snapshot_id'), position))
+            self._conn.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)", (playlist['id'], playlist.get('snapshot_id')))
+            self._conn.execute("DELETE FROM tracks WHERE playlist_id = ?", (playlist['id'],))
+            self._conn.commit()
+
+    def added(self, playlist_id, tracks, snapshot_id):
+        """Record (name, id, artist) tracks we appended to a playlist, and the snapshot_id Spotify returned for the write."""
+        with self._lock:
+            listed = self._conn.execute("SELECT snapshot_id FROM playlists WHERE id = ?", (playlist_id,)).fetchone()
+            synced = self._conn.execute("SELECT snapshot_id FROM synced WHERE playlist_id = ?", (playlist_id,)).fetchone()
+            if listed and synced and listed[0] == synced[0]:
+                # the mirror had the whole playlist, so with these tracks it matches the new snapshot
+                start = self._conn.execute("SELECT COALESCE(MAX(position), -1) + 1 FROM tracks WHERE playlist_id = ?", (playlist_id,)).fetchone()[0]
+                self._conn.executemany("INSERT INTO tracks VALUES (?, ?, ?, ?, ?)",
+                                       [(playlist_id, start + i, track_id, name, artist) for i, (name, track_id, artist) in enumerate(tracks)])
+                self._conn.execute("UPDATE synced SET snapshot_id = ? WHERE playlist_id = ?", (snapshot_id, playlist_id))
+            self._conn.execute("UPDATE playlists SET snapshot_id = ? WHERE id = ?", (snapshot_id, playlist_id))
+            self._conn.commit()
+
+    def invalidate(self, sp):
+        """Fetch the playlist list again on the next read."""
+        with self._lock:
+            self._conn.execute("DELETE FROM users WHERE user_id = ?", (self.user_id(sp),))
+            self._conn.commit()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Short-lived snapshot of the user's playback state.
+
+The playback helpers in utils.py all need the device list, and most also need
+what is currently playing or the queue. A PlaybackState fetches all three at
+once (in parallel), reuses them for PLAYBACK_TTL seconds, and is updated
+locally after our own pause/start/queue calls instead of being re-read.
+"""
+
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+
+PLAYBACK_TTL = 3   # seconds a snapshot is trusted; set from config.toml by spotify.py
+
+class PlaybackState:
+    def __init__(self, sp, ttl=None):
+        self.sp = sp
+        self.ttl = ttl
+        self.fetched_at = 0.0
+        self._devices = []
+        self._current = None
+        self._queue = None
+        self._lock = threading.RLock()
+
+    def _ttl(self):
+        return PLAYBACK_TTL if self.ttl is None else self.ttl
+
+    def refresh(self):
+        """Fetch devices, current playback and queue together."""
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            devices = executor.submit(telemetry.propagate(self.sp.devices))
+            current = executor.submit(telemetry.propagate(self.sp.currently_playing))
+            queue = executor.submit(telemetry.propagate(self.sp.queue))
+            devices, current, queue = devices.result(), current.result(), queue.result()
+        with self._lock:
+            self._devices = devices['devices'] if devices else []
+            self._current = current
+            self._queue = queue['queue'] if queue else []
+            self.fetched_at = time.time()
+
+    def _fresh(self):
+        with self._lock:
+            if time.time() - self.fetched_at > self._ttl():
+                self.refresh()
+
+    def invalidate(self):
+        with self._lock:
+            self.fetched_at = 0.0
+
+    @property
+    def devices(self):
+        self._fresh()
+        return self._devices
+
+    @property
+    def current(self):
+        """What sp.currently_playing() returned: a dict, or None when nothing is loaded."""
+        self._fresh()
+        return self._current
+
+    @property
+    def queue(self):
+        self._fresh()
+        with self._lock:
+            if self._queue is None:   # dropped by one of our own playback changes
+                result = self.sp.queue()
+                self._queue = result['queue'] if result else []
+            return self._queue
+
+    def has_devices(self):
+        return self.devices != []
+
+    def device_active(self):
+        devices = self.devices
+        return devices != [] and devices[0]['is_active']
+
+    def is_playing(self):
+        current = self.current
+        return bool(current and current['is_playing'])
+
+    # local updates after our own mutations
+
+    def set_playing(self, is_playing):
+        with self._lock:
+            if self._current is None:
+                self._current = {'is_playing': is_playing, 'item': None}
+            else:
+                self._current = dict(self._current, is_playing=is_playing)
+
+    def started(self, track=None):
+        """Playback was started on a new track or context, so the queue we had is stale."""
+        with self._lock:
+            self._current = {'is_playing': True, 'item': track}
+            self._queue = None
+
+    def queued(self, track_ids):
+        with self._lock:
+            if self._queue is not None:
+                self._queue = self._queue + [{'id': t} for t in track_ids]
+
+    def set_queue(self, queue):
+        with self._lock:
+            self._queue = queue
+
+    def adopt(self, other):
+        """Take over the contents of another snapshot of the same user's playback."""
+        with self._lock, other._lock:
+            self._devices = other._devices
+            self._current = other._current
+            self._queue = other._queue
+            self.fetched_at = other.fetched_at
+
+    def skipped(self):
+        """We skipped tracks, so what is playing and what is queued are both unknown."""
+        with self._lock:
+            self._current = None
+            self._queue = None
+            self.fetched_at = 0.0
+
+_states = weakref.WeakKeyDictionary()
+_states_lock = threading.Lock()
+
+def get_playback_state(sp):
+    """Return the PlaybackState shared by everything using this Spotify client."""
+    with _states_lock:
+        state = _states.get(sp)
+        if state is None:
+            state = PlaybackState(sp)
+            _states[sp] = state
+        return state
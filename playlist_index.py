@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fuzzy lookup of a playlist by name.
+
+The index is built once per list of (name, id) playlists. Names are
+normalized, split into character n-grams and put in an inverted index, so a
+lookup only scores the few playlists that share the most n-grams with the
+query instead of every playlist the user has.
+"""
+
+import threading
+from collections import Counter, OrderedDict, defaultdict
+from difflib import SequenceMatcher
+
+from cache import normalize
+
+MATCH_THRESHOLD = 0.85   # minimum SequenceMatcher ratio for a fuzzy match
+WRITE_THRESHOLD = 1.0    # adding tracks needs the exact name (after normalizing); "Road Trip 2025" must not pick "Road Trip 2024"
+SHORTLIST_SIZE = 20      # candidates scored per lookup
+NGRAM = 3
+
+def ngrams(key, n=NGRAM):
+    padded = f" {key} "
+    return {padded[i:i+n] for i in range(max(1, len(padded) - n + 1))}
+
+class PlaylistIndex:
+    def __init__(self, playlists):
+        self.playlists = list(playlists)   # (name, id) tuples, as returned by get_playlists
+        self.keys = [normalize(name) for name, pid in self.playlists]
+        self.exact = {}
+        self.postings = defaultdict(list)
+        for i, key in enumerate(self.keys):
+            self.exact.setdefault(key, i)
+            for gram in ngrams(key):
+                self.postings[gram].append(i)
+
+    def match(self, name, threshold=MATCH_THRESHOLD, shortlist=SHORTLIST_SIZE):
+        """Return (name, id, score) for the best matching playlist, or None.
+
+        An exact match after normalization scores 1.0. Otherwise the
+        shortlist is scored with SequenceMatcher; ties go to the playlist
+        listed first.
+        """
+        key = normalize(name)
+        if key in self.exact:
+            i = self.exact[key]
+            return self.playlists[i][0], self.playlists[i][1], 1.0
+
+        counts = Counter()
+        for gram in ngrams(key):
+            counts.update(self.postings.get(gram, ()))
+
+        best, best_score = None, 0.0
+        for i in sorted(i for i, _ in counts.most_common(shortlist)):
+            score = SequenceMatcher(None, key, self.keys[i]).ratio()
+            if score > best_score:
+                best, best_score = i, score
+
+        if best is None or best_score < threshold:
+            return None
+        return self.playlists[best][0], self.playlists[best][1], best_score
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+MAX_INDEXES = 32
+
+def get_index(playlists):
+    """Return the PlaylistIndex for this playlist snapshot, building it only once."""
+    snapshot = tuple(playlists)
+    with _lock:
+        index = _indexes.get(snapshot)
+        if index is not None:
+            _indexes.move_to_end(snapshot)
+            return index
+    index = PlaylistIndex(snapshot)
+    with _lock:
+        _indexes[snapshot] = index
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+def match_playlist(playlists, name, threshold=MATCH_THRESHOLD):
+    """Best (name, id, score) match for name among playlists, or None."""
+    return get_index(playlists).match(name, threshold)
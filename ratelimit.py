@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Client-side rate limiting for Spotify calls.
+
+A TokenBucket spaces out calls, and a 429 response pauses the bucket for the
+Retry-After period Spotify asks for, so every caller sharing the bucket backs
+off together rather than each one hammering the API. The process has one,
+owned by the shared transport session (transport.py), which also retries
+429s; the async backend takes its tokens from the same bucket. A Retry-After
+longer than max_pause is not waited out: pause() refuses it, and the caller
+gets the 429 instead of every session stalling behind it.
+"""
+
+import asyncio
+import threading
+import time
+
+SPOTIFY_RATE = 10       # calls per second on average
+SPOTIFY_BURST = 10      # calls allowed back to back
+MAX_PAUSE = 30          # longest Retry-After, in seconds, that is waited out
+
+def retry_after(headers, default=1.0):
+    """Seconds from a response's Retry-After header; default when it is missing or not a number."""
+    try:
+        return float(headers.get('Retry-After', default))
+    except ValueError:
+        return default
+
+class TokenBucket:
+    def __init__(self, rate=SPOTIFY_RATE, capacity=SPOTIFY_BURST, max_pause=MAX_PAUSE):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_pause = max_pause
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.waited = 0.0        # total seconds callers spent waiting for a token
+        self.throttled = 0       # number of 429 responses seen
+        self._lock = threading.Lock()
+
+    def _wait_time(self, tokens):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Block until tokens are available."""
+        while True:
+            with self._lock:
+                delay = self._wait_time(tokens)
+                if delay == 0.0:
+                    return
+                self.waited += delay
+            time.sleep(delay)
+
+    async def aacquire(self, tokens=1):
+        """acquire() for coroutines: waits without blocking the event loop."""
+        while True:
+            with self._lock:
+                delay = self._wait_time(tokens)
+                if delay == 0.0:
+                    return
+                self.waited += delay
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for the next seconds (Spotify's Retry-After). Returns False, without
+        pausing, when seconds is over max_pause: the request should fail rather than wait."""
+        with self._lock:
+            self.throttled += 1
+            if seconds > self.max_pause:
+                return False
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+            return True
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Maps the function names in tools.py to the code that runs them.
+
+Each handler takes (sp, args, ctx) and returns a ToolResult describing what
+happened, without touching the UI. spotify.py renders ToolResults; ctx holds
+per-session extras: a progress callback, and the session's EntityMemory
+under 'entities'. Listings are remembered there, and the tools that take
+track names resolve them against it before searching.
+
+ToolRegistry.run executes every function call from one model response.
+Calls that only read from Spotify and come before the first call that
+changes playback or the library run concurrently on a thread pool. Once
+they are done, the rest run one after another, in the order the model gave
+them, on the calling thread, so a read placed after a change sees it.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import telemetry
+import utils
+
+log = telemetry.get_logger('registry')
+
+# the module the handlers call: utils, or async_utils which has the same functions
+backend = utils
+
+def use_backend(module):
+    global backend
+    backend = module
+
+MAX_PARALLEL_TOOLS = 4
+
+@dataclass
+class ToolResult:
+    ok: bool
+    message: str = ''                            # what to tell the user
+    heading: str = ''                            # heading shown above items
+    items: list = field(default_factory=list)    # (name, id) pairs to list
+    kind: str = 'track'                          # Spotify URI type of the items
+    history: str = ''                            # what to record in the conversation for the model
+    reset: bool = False                          # the conversation should be cleared
+
+    def model_output(self):
+        """Text sent back to the model as the function call's output."""
+        return self.history or self.message
+
+@dataclass
+class Tool:
+    name: str
+    handler: Callable
+    mutates: bool = False                 # changes playback or the library
+    renderer: Optional[Callable] = None   # overrides the default rendering in spotify.py
+
+class ToolRegistry:
+    def __init__(self):
+        self.tools = {}
+
+    def register(self, name, mutates=False, renderer=None):
+        def decorator(handler):
+            self.tools[name] = Tool(name, handler, mutates, renderer)
+            return handler
+        return decorator
+
+    def call(self, sp, call, ctx):
+        tool = self.tools.get(call['name'])
+        if tool is None:
+            return ToolResult(False, "Sorry, I don't know how to do that.")
+        try:
+            with telemetry.span('tool', tool=tool.name):
+                return tool.handler(sp, call['args'] or {}, ctx)
+        except Exception:
+            log.exception("%s failed", tool.name)
+            telemetry.incr('tool_errors_total', tool=tool.name)
+            return ToolResult(False, "Sorry, something went wrong talking to Spotify. Please try again.")
+
+    def run(self, sp, calls, ctx=None):
+        """Run every call and return [(call, ToolResult)] in the order given."""
+        ctx = ctx if ctx is not None else {}
+        first_write = next((i for i, c in enumerate(calls) if c['name'] in self.tools and self.tools[c['name']].mutates), len(calls))
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_TOOLS) as executor:
+            futures = [executor.submit(telemetry.propagate(self.call), sp, c, ctx) for c in calls[:first_write]]
+            results = [future.result() for future in futures]
+        results += [self.call(sp, c, ctx) for c in calls[first_write:]]
+        return list(zip(calls, results))
+
+registry = ToolRegistry()
+
+def listing_history(heading, items, kind='track'):
+    """A listing as recorded in the conversation: one [name](spotify:kind:id) link per line, so the IDs
+    survive compaction (context.summarize_dump) and render as links in the history."""
+    return f"{heading}   \n " + "".join(f"[{name}](spotify:{kind}:{item_id})  \n" for name, item_id in items)
+
+def _listing(tracks_string, tracks_list, heading, failure, ctx, artist=None):
+    """tracks_list holds (name, id) pairs by artist, or (name, id, artist) triples."""
+    if not tracks_string:
+        return ToolResult(False, failure)
+    if ctx.get('entities') is not None:
+        ctx['entities'].remember(tracks_list, artist)
+    tracks_list = [(name, track_id) for name, track_id, *rest in tracks_list]
+    return ToolResult(True, heading=heading, items=tracks_list, history=listing_history("These are the tracks:", tracks_list))
+
+@registry.register('album_tracks')
+def _album_tracks(sp, args, ctx):
+    tracks_string, tracks_list = backend.album_tracks(sp, args)
+    return _listing(tracks_string, tracks_list,
+                    f"The tracks on the album {args['album'][0]['album_name']} by {args['album'][0]['artist']} are:",
+                    "I wasn't able to find that album/artist combination. Please try again.",
+                    ctx, args['album'][0]['artist'])
+
+@registry.register('top_tracks')
+def _top_tracks(sp, args, ctx):
+    tracks_string, tracks_list = backend.top_tracks(sp, args)
+    return _listing(tracks_string, tracks_list, f"The top tracks by {args['artist_name']} are:",
+                    "I wasn't able to look that up on Spotify.", ctx, args['artist_name'])
+
+@registry.register('playlist_tracks')
+def _playlist_tracks(sp, args, ctx):
+    playlist_string, user_playlists = backend.get_playlists(sp)
+    tracks_string, tracks_list = backend.playlist_tracks(sp, args, user_playlists)
+    return _listing(tracks_string, tracks_list, f"The tracks in the playlist {args['playlist_name']} are:",
+                    "I wasn't able to look that up on Spotify.", ctx)
+
+@registry.register('get_playlists')
+def _get_playlists(sp, args, ctx):
+    playlist_string, playlist_list = backend.get_playlists(sp)
+    if not playlist_string:
+        return ToolResult(False, "I wasn't able to get your playlists. Please ensure Spotify is running on this device.")
+    return ToolResult(True, heading="These are your current playlists:", items=playlist_list, kind='playlist',
+                      history=listing_history("These are your current playlists:", playlist_list, 'playlist'))
+
+@registry.register('play_track', mutates=True)
+def _play_track(sp, args, ctx):
+    if backend.play_track(sp, args, entities=ctx.get('entities')):
+        return ToolResult(True, f"OK I successfully started the track {args['tracks'][0]['track_name']} by {args['tracks'][0]['artist']}.")
+    return ToolResult(False, "I wasn't able to start that track. Please check your spelling ensure Spotify is running on this device.")
+
+@registry.register('play_album', mutates=True)
+def _play_album(sp, args, ctx):
+    if backend.play_album(sp, args):
+        return ToolResult(True, f"OK I successfully started the album {args['albums'][0]['album_name']} by {args['albums'][0]['artist']}.")
+    return ToolResult(False, "I wasn't able to start that album. Please check your spelling ensure Spotify is running on this device.")
+
+@registry.register('play_playlist', mutates=True)
+def _play_playlist(sp, args, ctx):
+    if backend.play_playlist(sp, args):
+        return ToolResult(True, "OK I successfully started the playlist.")
+    return ToolResult(False, "I wasn't able to start playback. Please check the playlist name and ensure Spotify is running on this device.")
+
+@registry.register('clear_queue', mutates=True)
+def _clear_queue(sp, args, ctx):
+    if backend.clear_queue(sp):
+        return ToolResult(True, "OK I cleared the queue. The current track keeps playing.")
+    return ToolResult(False, "I wasn't able to clear the queue. Perhaps it was already empty or Spotify was not running on this device.")
+
+@registry.register('add_to_playlist', mutates=True)
+def _add_to_playlist(sp, args, ctx):
+    if backend.add_items_to_playlist(sp, args, entities=ctx.get('entities')):
+        return ToolResult(True, "OK I added those tracks to the playlist.")
+    return ToolResult(False, "I had a problem adding those tracks to your playlist. I only add to a playlist whose name matches exactly, so please check the name.")
+
+@registry.register('add_to_queue', mutates=True)
+def _add_to_queue(sp, args, ctx):
+    if backend.add_items_to_queue(sp, args, progress=ctx.get('queue_progress'), entities=ctx.get('entities')):
+        return ToolResult(True, "OK I added those tracks to your queue.")
+    return ToolResult(False, "I had a problem adding those tracks to your queue. Please ensure Spotify is running on this device.")
+
+@registry.register('pause', mutates=True)
+def _pause(sp, args, ctx):
+    if backend.pause(sp):
+        return ToolResult(True, "OK I successfully paused playback.")
+    return ToolResult(False, "I wasn't able to pause playback. Please ensure Spotify is running on this device.")
+
+@registry.register('start', mutates=True)
+def _start(sp, args, ctx):
+    if backend.start(sp):
+        return ToolResult(True, "OK I successfully started playback.")
+    return ToolResult(False, "I wasn't able to start playback. Please ensure Spotify is running on this device.")
+
+@registry.register('reset', mutates=True)
+def _reset(sp, args, ctx):
+    if ctx.get('entities') is not None:   # "those tracks" means nothing in a new conversation
+        ctx['entities'].clear()
+    return ToolResult(True, reset=True)
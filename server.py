@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless HTTP API for the chatbot, for clients other than the Streamlit app.
+
+    uvicorn server:app
+
+POST /chat   {"sid": "...", "prompt": "..."}
+    Runs one chat turn (chat.run_turn) for the login sid and returns what the
+    user would have seen: {"messages": [...], "results": [...]}. sid is the
+    id of a login in the token store; users log in once through the
+    Streamlit app, which puts it in the URL.
+POST /reset  {"sid": "..."}
+    Starts a new conversation.
+GET /healthz, GET /metrics
+
+Turns run on a bounded thread pool. When every worker is busy and the wait
+queue is full, requests are answered 503 with Retry-After instead of piling
+up. Turns for the same sid run one after another. They wait on the event
+loop, not on a worker, and a sid that already has per_sid turns gets 429,
+so one busy client can't hold the pool. Conversations, each session's
+EntityMemory and the names of its recent tool calls (for tool selection)
+are kept in SQLite rather than in the process, so every worker process on
+the node can serve every user. A turn holds its sid in the same database
+from load to save; a request for a sid that another process is serving
+gets 429 too, rather than two turns overwriting each other's conversation.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import toml
+from spotipy import Spotify
+from spotipy.cache_handler import CacheHandler
+from spotipy.oauth2 import SpotifyOAuth
+
+import chat
+import telemetry
+import transport
+from entities import EntityMemory
+
+config = toml.load("./config.toml")
+log = telemetry.get_logger('server')
+
+class SessionBusy(Exception):
+    """The sid already has as many turns running or waiting as it may."""
+
+TURN_LEASE = 300   # seconds a turn may hold its sid; the hold of a process that died ends after this
+
+class SessionStore:
+    """sid -> (conversation, EntityMemory, recent tool names) in SQLite."""
+
+    def __init__(self, path, lease=TURN_LEASE):
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, messages TEXT, entities TEXT, updated_at REAL, recent_tools TEXT)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS holds (sid TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+        try:   # tables from before recent_tools was kept
+            self._conn.execute("ALTER TABLE sessions ADD COLUMN recent_tools TEXT")
+        except sqlite3.OperationalError:
+            pass
+        self._conn.commit()
+
+    @contextmanager
+    def hold(self, sid):
+        """Hold sid from load() to save(), across every process using the database.
+        Raises SessionBusy when another turn holds it."""
+        owner, now = uuid.uuid4().hex, time.time()
+        with self._lock:
+            # one statement, so two processes can't both take it
+            claimed = self._conn.execute("INSERT INTO holds (sid, owner, expires_at) VALUES (?, ?, ?) "
+                                         "ON CONFLICT (sid) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                                         "WHERE holds.expires_at < ?", (sid, owner, now + self.lease, now)).rowcount
+            self._conn.commit()
+        if not claimed:
+            raise SessionBusy(sid)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._conn.execute("DELETE FROM holds WHERE sid = ? AND owner = ?", (sid, owner))
+                self._conn.commit()
+
+    def load(self, sid):
+        with self._lock:
+            row = self._conn.execute("SELECT messages, entities, recent_tools FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        if row is None:
+            return chat.new_conversation(), EntityMemory(), []
+        return json.loads(row[0]), EntityMemory.load(json.loads(row[1])), json.loads(row[2] or '[]')
+
+    def save(self, sid, messages, entities, recent_tools=()):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sessions (sid, messages, entities, updated_at, recent_tools) VALUES (?, ?, ?, ?, ?)",
+                               (sid, json.dumps(messages), json.dumps(entities.dump()), time.time(), json.dumps(list(recent_tools))))
+            self._conn.commit()
+
+class TokenStoreCacheHandler(CacheHandler):
+    # tokens come from the store the Streamlit app logs users in to, and that the refresher keeps fresh
+    def __init__(self, store, sid):
+        self.store = store
+        self.sid = sid
+
+    def get_cached_token(self):
+        return self.store.get(self.sid)
+
+    def save_token_to_cache(self, token_info):
+        self.store.set(self.sid, token_info)
+
+class ChatService:
+    """Runs turns on a bounded pool and refuses work it could not start soon."""
+
+    def __init__(self, config):
+        self.config = config
+        self.settings = config["server"]
+        self.token_store = chat.setup(config)
+        if self.token_store is None:
+            raise RuntimeError("server.py needs [token_store] enabled in config.toml")
+        self.sessions = SessionStore(self.settings["session_path"], self.settings["turn_lease"])
+        self.executor = ThreadPoolExecutor(max_workers=self.settings["workers"], thread_name_prefix='turn')
+        self.capacity = self.settings["workers"] + self.settings["queue"]
+        self.pending = 0   # turns running or waiting for a worker; only touched on the event loop
+        self._clients = OrderedDict()   # sid -> Spotify, most recently used last
+        self._sids = {}   # sid -> [asyncio.Lock, turns running or waiting]; only touched on the event loop, dropped when idle
+        self._lock = threading.Lock()
+        self._openai_client = None
+
+    def openai_client(self):
+        with self._lock:
+            if self._openai_client is None:
+                from openai import OpenAI
+                self._openai_client = OpenAI(api_key=os.environ['OPENAI_API_KEY'])
+            return self._openai_client
+
+    def spotify(self, sid):
+        """A Spotify client per sid, reused so its playback snapshot is too."""
+        with self._lock:
+            sp = self._clients.get(sid)
+            if sp is None:
+                auth_manager = SpotifyOAuth(**self.config["spotipy"], cache_handler=TokenStoreCacheHandler(self.token_store, sid))
+                sp = Spotify(auth_manager=auth_manager, requests_session=transport.get_shared_session(**self.config["transport"]),
+                             requests_timeout=self.config["transport"]["timeout"])
+                self._clients[sid] = sp
+                while len(self._clients) > self.settings["max_clients"]:
+                    self._clients.popitem(last=False)
+            self._clients.move_to_end(sid)
+            return sp
+
+    def turn(self, sid, prompt):
+        """One chat turn, on a worker thread."""
+        with telemetry.turn(entry='server'), self._hold(sid):
+            messages, entities, recent_tools = self.sessions.load(sid)
+            before = len(messages)
+            results = chat.run_turn(self.spotify(sid), self.openai_client(), messages, prompt, self.config["chatbot"],
+                                    entities=entities, recent_tools=recent_tools)
+            self.sessions.save(sid, messages, entities, recent_tools)
+            reset = any(result.reset for call, result in results)
+            return {"messages": messages[1:] if reset else messages[before + 1:],
+                    "results": [{"name": call['name'], "ok": result.ok, "message": result.message, "heading": result.heading,
+                                 "items": result.items, "kind": result.kind} for call, result in results]}
+
+    def reset(self, sid):
+        with self._hold(sid):
+            self.sessions.save(sid, chat.new_conversation(), EntityMemory())
+        return {"messages": []}
+
+    @contextmanager
+    def _hold(self, sid):
+        try:
+            with self.sessions.hold(sid):
+                yield
+        except SessionBusy:
+            telemetry.incr('server_rejected_total', reason='sid_elsewhere')
+            raise
+
+    async def submit_for(self, sid, func, *args):
+        """submit(), one at a time per sid. Raises SessionBusy when the sid already has per_sid turns."""
+        entry = self._sids.get(sid)
+        if entry is None:
+            entry = self._sids[sid] = [asyncio.Lock(), 0]
+        if entry[1] >= self.settings["per_sid"]:
+            telemetry.incr('server_rejected_total', reason='sid')
+            raise SessionBusy(sid)
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await self.submit(func, *args)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._sids[sid]
+
+    async def submit(self, func, *args):
+        """Run func on the pool, or return None when the pool and its queue are full."""
+        if self.pending >= self.capacity:
+            telemetry.incr('server_rejected_total', reason='capacity')
+            return None
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.pending -= 1
+
+service = None
+
+async def _read_json(receive, limit):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > limit:
+            raise ValueError("request body too large")
+        if not message.get('more_body'):
+            break
+    return json.loads(body or b'{}')
+
+async def _send(send, status, payload, content_type=b'application/json', headers=()):
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode()), *headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def _lifespan(receive, send):
+    global service
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            service = ChatService(config)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            service.executor.shutdown(wait=False, cancel_futures=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """The ASGI application."""
+    global service
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    if service is None:   # the server doesn't send lifespan events
+        service = ChatService(config)
+
+    method, path = scope['method'], scope['path']
+    if method == 'GET' and path == '/healthz':
+        await _send(send, 200, {"pending": service.pending, "capacity": service.capacity})
+        return
+    if method == 'GET' and path == '/metrics':
+        await _send(send, 200, telemetry.render_prometheus().encode(), b'text/plain; version=0.0.4')
+        return
+    if method != 'POST' or path not in ('/chat', '/reset'):
+        await _send(send, 404, {"error": "not found"})
+        return
+
+    try:
+        request = await _read_json(receive, service.settings["max_body"])
+        sid = request["sid"]
+        prompt = request["prompt"] if path == '/chat' else None
+    except (ValueError, KeyError, TypeError):
+        await _send(send, 400, {"error": "expected a JSON body with sid" + (" and prompt" if path == '/chat' else "")})
+        return
+    if service.token_store.get(sid) is None:
+        await _send(send, 401, {"error": "unknown sid; log in through the Streamlit app first"})
+        return
+
+    try:
+        if path == '/chat':
+            reply = await service.submit_for(sid, service.turn, sid, prompt)
+        else:
+            reply = await service.submit_for(sid, service.reset, sid)
+    except SessionBusy:
+        await _send(send, 429, {"error": "this session already has a request in progress"},
+                    headers=[(b'retry-after', str(service.settings["retry_after"]).encode())])
+        return
+    except Exception:
+        log.exception("%s failed", path)
+        await _send(send, 500, {"error": "internal error"})
+        return
+    if reply is None:
+        await _send(send, 503, {"error": "busy, try again shortly"},
+                    headers=[(b'retry-after', str(service.settings["retry_after"]).encode())])
+        return
+    await _send(send, 200, reply)
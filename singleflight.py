@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Request coalescing for identical calls that are in flight at the same time.
+
+When several sessions ask for the same thing at once (the sidebar
+suggestions are the usual hot keys) only the first caller for a key makes
+the call; callers that arrive while it is running wait for it and get the
+same result, or the same exception. Nothing is kept once the call returns,
+so this is not a cache: it only collapses bursts.
+
+    results = flights.do('search', ('track', query), lambda: sp.search(q=query, type='track', limit=5))
+
+stream() does the same for a streamed model response: callers share one
+stream and each reads every event from the start, whenever it joined. A
+stream can only be joined for STREAM_JOIN_WINDOW seconds after it started,
+and not at all once the caller that started it stops reading.
+ado() is do() for coroutines on the async backend's event loop.
+"""
+
+import asyncio
+import threading
+import time
+
+import telemetry
+
+log = telemetry.get_logger('singleflight')
+
+STREAM_JOIN_WINDOW = 10   # seconds after a stream started that an identical request may still join it
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.callers = 1
+        self.started = time.monotonic()
+
+class SharedStream:
+    """An iterator read by several threads. Events are buffered, so every reader sees all of them;
+    whichever reader is ahead pulls the next one from the source."""
+
+    def __init__(self, source, on_done=None):
+        self._source = iter(source)
+        self._on_done = on_done
+        self._events = []
+        self._error = None
+        self._lock = threading.Lock()
+        self.done = False
+
+    def reader(self):
+        i = 0
+        while True:
+            with self._lock:
+                if i == len(self._events) and not self.done:
+                    try:
+                        self._events.append(next(self._source))
+                    except StopIteration:
+                        self._finish()
+                    except Exception as e:
+                        self._error = e
+                        self._finish()
+                if i < len(self._events):
+                    event = self._events[i]
+                elif self._error is not None:
+                    raise self._error
+                else:
+                    return
+            i += 1
+            yield event
+
+    def _finish(self):
+        self.done = True
+        if self._on_done:
+            self._on_done()
+
+class SingleFlight:
+    def __init__(self):
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._flights = {}   # (kind, key) -> _Flight
+        self._streams = {}   # (kind, key) -> _Flight whose value is a SharedStream
+        self._tasks = {}     # (kind, key) -> _Flight whose value is an asyncio.Task
+        self.stats = {'calls': 0, 'collapsed': 0, 'peak_callers': 0}
+
+    def _join(self, table, full, max_age=None):
+        """(flight, True) for the caller that makes the call, (flight, False) for one that waits for it.
+        A flight older than max_age seconds is not joined; the caller starts a new one."""
+        with self._lock:
+            self.stats['calls'] += 1
+            flight = table.get(full)
+            if flight is None or (max_age is not None and time.monotonic() - flight.started > max_age):
+                flight = table[full] = _Flight()
+                return flight, True
+            flight.callers += 1
+            self.stats['collapsed'] += 1
+            self.stats['peak_callers'] = max(self.stats['peak_callers'], flight.callers)
+        telemetry.incr('singleflight_collapsed_total', kind=full[0])
+        log.debug("%s: joined a call already in flight (%d callers)", full[0], flight.callers)
+        return flight, False
+
+    def _forget(self, table, full, flight):
+        with self._lock:
+            if table.get(full) is flight:
+                del table[full]
+
+    def do(self, kind, key, func):
+        """func(), shared with every caller that asks for the same (kind, key) while it runs."""
+        if not self.enabled:
+            return func()
+        full = (kind, key)
+        flight, leader = self._join(self._flights, full)
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = func()
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            self._forget(self._flights, full, flight)
+            flight.event.set()
+
+    def stream(self, kind, key, create):
+        """(iterator, shared) for create(), which returns an iterator of events. Callers with the same
+        (kind, key) share it while the one that created it is still reading it, for at most
+        STREAM_JOIN_WINDOW seconds; shared is False for the one that created it."""
+        if not self.enabled:
+            return create(), False
+        full = (kind, key)
+        flight, leader = self._join(self._streams, full, STREAM_JOIN_WINDOW)
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value.reader(), True
+        try:
+            flight.value = SharedStream(create(), lambda: self._forget(self._streams, full, flight))
+            return self._leader_reader(full, flight), False
+        except BaseException as e:
+            flight.error = e
+            self._forget(self._streams, full, flight)
+            raise
+        finally:
+            flight.event.set()
+
+    def _leader_reader(self, full, flight):
+        try:
+            yield from flight.value.reader()
+        finally:   # read to the end, or abandoned (a rerun, an error while drawing): nobody new may join
+            self._forget(self._streams, full, flight)
+
+    async def ado(self, kind, key, func):
+        """await func(), shared like do(). All callers must be on the same event loop."""
+        if not self.enabled:
+            return await func()
+        full = (kind, key)
+        flight, leader = self._join(self._tasks, full)
+        if leader:
+            flight.value = asyncio.ensure_future(func())
+            flight.value.add_done_callback(lambda task: self._forget(self._tasks, full, flight))
+        # one caller being cancelled must not cancel the call the others wait for
+        return await asyncio.shield(flight.value)
+
+# Shared by every session in the process; see [singleflight] in config.toml.
+flights = SingleFlight()
@@ -4,11 +4,12 @@
 @author: michaelsadowski
 """
 
+import time
+RUN_START = time.perf_counter()   # start of this run of the script, for the startup/rerun timings
 
 import streamlit as st
 import os
-
-from openai import OpenAI
+import itertools
 
 import toml
 from spotipy import Spotify
@@ -16,68 +17,186 @@ from spotipy.cache_handler import CacheHandler
 from spotipy.exceptions import SpotifyOauthError
 from spotipy.oauth2 import SpotifyOAuth
 
-# Load the configuration from the TOML file
-config = toml.load("./config.toml")
+@st.cache_resource(show_spinner=False)
+def load_config():
+    # Load the configuration from the TOML file
+    return toml.load("./config.toml")
+
+config = load_config()
+
+import telemetry
+log = telemetry.get_logger('app')
 
-from utils import play_album, play_playlist, album_tracks,chat_request, extract_response_details, clear_queue, add_items_to_queue, top_tracks, playlist_tracks, pause, start, play_track, get_playlists, add_items_to_playlist
-from tools import tools
+import chat
+from entities import EntityMemory
+import tokens
+import transport
+from registry import registry
 
-#OPENAI_API_KEY = <insert key here, or better use the envionment variable below>
-OPENAI_API_KEY = os.environ['OPENAI_API_KEY'] 
+@st.cache_resource(show_spinner=False)
+def get_openai_client():
+    from openai import OpenAI   # imported when the first prompt arrives, so the page can render before the SDK loads
 
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    #OPENAI_API_KEY = <insert key here, or better use the envionment variable below>
+    OPENAI_API_KEY = os.environ['OPENAI_API_KEY'] 
+    return OpenAI(api_key=OPENAI_API_KEY)
+
+@st.cache_resource(show_spinner=False)
+def init_process():
+    """Set up everything shared by the whole process, once. Returns (token_store, startup seconds)."""
+    token_store = chat.setup(config)
+    startup_seconds = time.perf_counter() - RUN_START   # includes the imports on a cold start
+    telemetry.observe('startup', startup_seconds)
+    log.info("started in %.2fs", startup_seconds)
+    return token_store, startup_seconds
+
+token_store, startup_seconds = init_process()
 
 class StreamlitCacheHandler(CacheHandler):
-    def __init__(self):
-        self.session_id = st.session_state.get("session_id")
+    # The token is also kept on the handler itself: helpers call Spotify from
+    # worker threads, where st.session_state is not available, so sync() hands
+    # it over on the script thread on every rerun. With a token store, the
+    # store is read every time so tokens renewed by the background refresher
+    # are picked up.
+    def __init__(self, session_id=None):
+        self.session_id = session_id
+        self.token_info = None
 
     def get_cached_token(self):
-        return st.session_state.get("spotipy_token")
+        if token_store is not None and self.session_id:
+            self.token_info = token_store.get(self.session_id) or self.token_info
+        if self.token_info is None:
+            self.token_info = st.session_state.get("spotipy_token")
+        return self.token_info
+
+    def sync(self):
+        """On the script thread: give the handler and st.session_state the newest token either has."""
+        token_info = st.session_state.get("spotipy_token")
+        if token_store is not None and self.session_id:
+            token_info = token_store.get(self.session_id) or token_info
+        if self.token_info and (token_info is None or self.token_info.get('expires_at', 0) > token_info.get('expires_at', 0)):
+            token_info = self.token_info   # refreshed on a worker thread since the last rerun
+        self.token_info = token_info
+        if token_info is not None:
+            st.session_state["spotipy_token"] = token_info
 
     def save_token_to_cache(self, token_info):
-        st.session_state["spotipy_token"] = token_info
+        self.token_info = token_info
+        if token_store is not None and self.session_id:
+            token_store.set(self.session_id, token_info)
+        try:
+            st.session_state["spotipy_token"] = token_info
+        except Exception:   # refreshed on a worker thread; the handler copy is enough
+            pass
 
-def get_auth_manager():
+def get_auth_manager(session_id=None):
     """
     Returns a spotipy.oauth2.SpotifyOAuth object.
     """
-    return SpotifyOAuth(**config["spotipy"], cache_handler=StreamlitCacheHandler())
+    return SpotifyOAuth(**config["spotipy"], cache_handler=StreamlitCacheHandler(session_id))
 
 def callback():
     code = st.query_params.get("code")
-    if code:
-        try:
-            token_info = get_auth_manager().get_access_token(code)
-        except SpotifyOauthError:
-            pass
+    state = st.query_params.get("state")
     del st.query_params["code"]
+    if "state" in st.query_params:
+        del st.query_params["state"]
+    if not tokens.check_oauth_state(state):   # not a login this app started
+        log.warning("Ignoring an OAuth callback with an unknown state")
+        return
+    # a new id for every login; an id that came in with the request could be one an attacker chose
+    session_id = tokens.new_session_id()
+    try:
+        get_auth_manager(session_id).get_access_token(code, check_cache=False)
+    except SpotifyOauthError:
+        return
+    st.session_state["session_id"] = session_id
+    st.session_state.pop("sp", None)   # rebuilt with the new id
     
-def output(role, content, extra_arg=None):  #output to screen and to messages
-    #st.session_state.messages.append({"role": role, "content": content+str(extra_arg).strip('[]')}) 
-    print(f'role: {role}  content:{content}',flush=True)
-    with st.chat_message(role):
-        st.session_state.messages.append({"role": role, "content": content})
-        st.write(content)
-    return
-
-background ="The user wants to control Spotify.\
-            Use the tools functions provided to get information from Spotify or take actions in Spotify. If the user asks you to take actions in Spotify, \
-            such as pause or start playback, do not just reply that you took the action--you should use the tools functions. If you are not certain what to do, or if you \
-            don't have all information needed to call a tools function, ask the user for clarification or more details. If the user asks general questions about music then answer those concisely. But don't\
-            answer questions that are not related to music."
+class StreamlitView(chat.View):  #draws a turn in the chat window
+    def __init__(self):
+        self.status = None   # add_to_queue progress box, opened on the first track
+
+    def text(self, content):
+        with st.chat_message("system"):
+            st.write(content)
+
+    def stream(self, response):
+        deltas = response.text_deltas()
+        first = next(deltas, None)   # wait for the first bit of text, if there is any
+        if first is None:
+            return None
+        with st.chat_message("system"):
+            return st.write_stream(itertools.chain([first], deltas))
+
+    def context(self, report):
+        st.session_state.setdefault("prompt_tokens", []).append(report)
+        st.sidebar.caption(f"Last prompt: {report['after']} tokens (full history {report['before']})")
+
+    def queue_progress(self, rec, found):
+        if self.status is None:
+            self.status = st.chat_message("system").status("Adding the tracks to your queue...")
+        if found:
+            self.status.write(f"Queued {found[2]} by {found[1]}")
+        else:
+            self.status.write(f"Couldn't find {rec['track_name']} by {rec['artist']}")
+
+    def queue_done(self):
+        if self.status is not None:
+            self.status.update(label="Done adding tracks.", state="complete")
+
+    def result(self, call, result):
+        tool = registry.tools.get(call['name'])
+        if tool and tool.renderer:
+            tool.renderer(call, result)
+        elif result.reset:
+            pass   # the conversation was cleared; it is drawn empty on the next rerun
+        elif result.items:
+            with st.chat_message("system"):
+                # one element for the whole listing; a long playlist would otherwise be hundreds
+                st.markdown(f"{result.heading}  \n" + "".join(f"[{name}](spotify:{result.kind}:{item_id})  \n" for name, item_id in result.items))
+        elif result.message:
+            self.text(result.message)
+
+def split_history(messages, turns):  #(older, recent): recent starts at the last `turns` user messages
+    user_positions = [i for i, msg in enumerate(messages) if msg["role"] == "user"]
+    if len(user_positions) <= turns:
+        return [], messages
+    cut = user_positions[-turns]
+    return messages[:cut], messages[cut:]
+
+def render_history(messages):
+    for msg in messages:
+        with st.chat_message(msg["role"]):
+            st.markdown(msg["content"])
 
 st.set_page_config(page_title="SpotiBot")
 
-st.markdown(
-    """
+CSS = """
     <style>
     #MainMenu {visibility: hidden;}
     footer {visibility: hidden;}
     .stDeployButton {visibility: hidden;}
     </style>
-    """,
-    unsafe_allow_html=True
-)
+    """
+
+# one element for the whole sidebar rather than one per line
+SIDEBAR = "\n\n".join([
+    r"$\textsf{\Large Here are some ideas}$",
+    "What were David Bowie's top tracks?",
+    "What are some less popular, but influential Neil Young songs. Make a playlist called Deep Neil with those songs.",
+    "What are all my playlists?",
+    "Play my _______ playlist",
+    "Play Outlandos D'Amour by the Police",
+    "What tracks are on Communique by Dire Straits?",
+    "What tracks are in my my playlist ______?",
+    "Pause (only works when the player on this device is active)",
+    "Start (only works when the player on this device is active)",
+    "Tell me about how Bowie and Lennon collaborated to write the song Fame.",
+    "Give me a list of the best Chillwave songs since 2010. (after the list is returned, ask to add them to a new playlist)",
+])
+
+st.markdown(CSS, unsafe_allow_html=True)
 
 st.title("Spotify AI Control Chatbot")
 
@@ -85,181 +204,63 @@ st.markdown("I'm an AI chatbot that can control Spotify for you. Spotify must be
             'What were David Bowie's top songs', 'Add those songs to the queue' or 'pause play'. You can also ask me \
             general questions about music, e.g., 'Tell me about how Bowie and Lennon collaborated to write the song Fame.'")
 
-st.sidebar.markdown(r"$\textsf{\Large Here are some ideas}$")    
-st.sidebar.markdown("What were David Bowie's top tracks?")
-st.sidebar.markdown("What are some less popular, but influential Neil Young songs. Make a playlist called Deep Neil with those songs.")
-st.sidebar.markdown("What are all my playlists?")
-st.sidebar.markdown("Play my _______ playlist")
-st.sidebar.markdown("Play Outlandos D'Amour by the Police")
-st.sidebar.markdown("What tracks are on Communique by Dire Straits?")
-st.sidebar.markdown("What tracks are in my my playlist ______?")
-st.sidebar.markdown("Pause (only works when the player on this device is active)")
-st.sidebar.markdown("Start (only works when the player on this device is active)")
-st.sidebar.markdown("Tell me about how Bowie and Lennon collaborated to write the song Fame.")
-st.sidebar.markdown("Give me a list of the best Chillwave songs since 2010. (after the list is returned, ask to add them to a new playlist)")
+st.sidebar.markdown(SIDEBAR)
+
+if st.query_params.get("code"):
+    callback()
+
+if token_store is not None and "session_id" not in st.session_state and st.query_params.get("sid"):
+    # only a sid the store already holds a login for is taken from the URL
+    token_info = token_store.get(st.query_params["sid"])
+    if token_info:   # logged in from an earlier browser session
+        st.session_state["session_id"] = st.query_params["sid"]
+        st.session_state["spotipy_token"] = token_info
+    else:
+        del st.query_params["sid"]
+if token_store is not None and "spotipy_token" in st.session_state:
+    st.query_params["sid"] = st.session_state["session_id"]
 
 if 'sp' in st.session_state:
     sp = st.session_state["sp"]    
 else: 
-    sp = Spotify(auth_manager=get_auth_manager())
+    # every session shares one pooled, rate-limited HTTP session
+    sp = Spotify(auth_manager=get_auth_manager(st.session_state.get("session_id")), requests_session=transport.get_shared_session(**config["transport"]),
+                 requests_timeout=config["transport"]["timeout"])
     st.session_state["sp"] = sp
-
-if st.query_params.get("code"):
-    callback()
+sp.auth_manager.cache_handler.sync()
 
 if "spotipy_token" not in st.session_state:
     if st.button("Log in to Spotify"):
         # prevents a new tab from being opened
         st.markdown(f'<meta http-equiv="refresh" content="0; '
-                    f'url={sp.auth_manager.get_authorize_url()}"/>',
+                    f'url={sp.auth_manager.get_authorize_url(state=tokens.new_oauth_state())}"/>',
                     unsafe_allow_html=True)    
 
+if "entities" not in st.session_state:
+    # every track listed in this session, so "add those to the queue" needs no searches
+    st.session_state["entities"] = EntityMemory()
+
 if "messages" not in st.session_state:
-    st.session_state.messages = []  
-    st.session_state.messages.append({"role": "system", "content": background})
+    st.session_state.messages = chat.new_conversation()
+
+# only the last few turns are drawn on every rerun; older ones on request
+older, recent = split_history(st.session_state.messages[1:], config["chatbot"]["history_turns"])
+if older and st.toggle(f"Show {len(older)} older messages", key="show_older"):
+    render_history(older)
+render_history(recent)
 
-for msg in st.session_state.messages[1:]:
-    with st.chat_message(msg["role"]):
-        st.markdown(msg["content"])  
+# time to get from the top of the script to here, i.e. what every rerun costs before any work for a prompt
+rerun_seconds = time.perf_counter() - RUN_START
+telemetry.observe('rerun', rerun_seconds)
+st.sidebar.caption(f"Startup {startup_seconds:.2f}s, this rerun {rerun_seconds * 1000:.0f} ms")
         
 if "spotipy_token" in st.session_state: 
     if prompt := st.chat_input("What do you want me to do?"):
+        with telemetry.turn():
+            openai_client = get_openai_client()
     
-        st.session_state.messages.append({"role": "user", "content": prompt})
-        with st.chat_message("user"):
-            st.markdown(prompt)
-                    
-        #print(st.session_state.messages,flush=True)
-        
-        response = chat_request(openai_client,st.session_state.messages, tools=tools, tool_choice="auto")
-        
-        #print(f'AI response: {response}',flush=True)
-    
-        response_text, function_name, function_args = extract_response_details(response)   
-        
-        print(f"Function Name: {function_name}",flush=True)
-        print(f"Function Arguments: {function_args}",flush=True)
-    
-        if response_text != None:
-            output(role="system", content=response_text)
-        
-        if not(function_name):
-            # Nothing to do. Go back and get clarification
-            pass
-        
-        elif function_name == 'album_tracks':
-            tracks_string, tracks_list = album_tracks(sp,function_args)
-            print(tracks_list)
-            if tracks_string:
-                with st.chat_message("system"):
-                    st.session_state.messages.append({"role": "system", "content": f"These are the tracks: {tracks_string}"})         
-                    st.write(f"The tracks on the album {function_args['album'][0]['album_name']} by {function_args['album'][0]['artist']} are:  \n")
-                    for track in tracks_list:
-                        st.write(f"[{track[0]}](spotify:track:{track[1]})")
-            else:
-                output(role="system", content="I wasn't able to find that album/artist combination. Please try again.") 
-                
-        elif function_name == 'play_track':
-            result = play_track(sp,function_args)
-            if result:  
-                output(role="system", content=f"OK I successfully started the track {function_args['tracks'][0]['track_name']} by {function_args['tracks'][0]['artist']}.")
-            else:
-                output(role="system", content="I wasn't able to start that track. Please check your spelling ensure Spotify is running on this device.") 
-                
-        elif function_name == 'play_album':
-            result = play_album(sp,function_args)
-            print(function_args)
-            if result:  
-                output(role="system", content=f"OK I successfully started the album {function_args['albums'][0]['album_name']} by {function_args['albums'][0]['artist']}.")
-            else:
-                output(role="system", content="I wasn't able to start that album. Please check your spelling ensure Spotify is running on this device.") 
-
-        elif function_name == 'clear_queue':
-            output(role="system", content="Note: there is no clear queue function so as a workaround I'm going to try to skip through the whole queue.")
-            result = clear_queue(sp)
-            if result:  
-                output(role="system", content="OK I think I successfully skipped the queue.")
-            else:
-                output(role="system", content="I wasn't able to clear the queue. Perhaps it was already empty or Spotify was not running on this device.")
-                
-        elif function_name == 'top_tracks':
-            tracks_string, tracks_list = top_tracks(sp,function_args)
-            print(tracks_list)
-            print(function_args)
-            if tracks_string:
-                with st.chat_message("system"):
-                    st.session_state.messages.append({"role": "system", "content": f"These are the tracks:   \n {tracks_string}"})     
-                    st.write(f"The top tracks by {function_args['artist_name']} are:  \n")
-                    for track in tracks_list:
-                        st.write(f"[{track[0]}](spotify:track:{track[1]})")
-            else:
-                output(role="system", content="I wasn't able to look that up on Spotify.")
-                
-        elif function_name == 'add_to_playlist':
-            result = add_items_to_playlist(sp,function_args)
-            if result:
-                output(role="system", content="OK I added those tracks to the playlist.")
-            else:
-                output(role="system", content="I had a problem adding those tracks to your playlist.")
-                
-        elif function_name == 'add_to_queue':
-            output(role="system", content="OK I'm adding the tracks. This can take a minute.")
-            result = add_items_to_queue(sp,function_args)
-            if result:
-                output(role="system", content="OK I added those tracks to your queue.")
-            else:
-                output(role="system", content="I had a problem adding those tracks to your queue. Please ensure Spotify is running on this device.")
-                
-        elif function_name == 'pause':
-            result = pause(sp)
-            if result:  
-                output(role="system", content="OK I successfully paused playback.")
-            else:
-                output(role="system", content="I wasn't able to pause playback. Please ensure Spotify is running on this device.")
-                
-        elif function_name == 'start':
-            result = start(sp)
-            if result:  
-                output(role="system", content="OK I successfully started playback.")
-            else:
-                output(role="system", content="I wasn't able to start playback. Please ensure Spotify is running on this device.") 
-                
-        elif function_name == 'get_playlists':
-            playlist_string, playlist_list = get_playlists(sp)
-            if playlist_string:      
-                with st.chat_message("system"):
-                    st.session_state.messages.append({"role": "system", "content": f"These are your current playlists:   \n {playlist_string}"})     
-                    st.write("These are your current playlists:   \n")
-                    for playlist in playlist_list:
-                        st.write(f"[{playlist[0]}](spotify:playlist:{playlist[1]})")
-            else:
-                output(role="system", content="I wasn't able to get your playlists. Please ensure Spotify is running on this device.") 
-                
-        elif function_name == 'playlist_tracks':
-            playlist_string,user_playlists = get_playlists(sp)
-            tracks_string, tracks_list = playlist_tracks(sp,function_args,user_playlists)
-            print(tracks_list)
-            print(function_args)
-            if tracks_string:
-                with st.chat_message("system"):
-                    st.session_state.messages.append({"role": "system", "content": f"These are the tracks:   \n {tracks_string}"})     
-                    st.write(f"The tracks in the playlist {function_args['playlist_name']} are:   \n")
-                    for track in tracks_list:
-                        st.write(f"[{track[0]}](spotify:track:{track[1]})")
-            else:
-                output(role="system", content="I wasn't able to look that up on Spotify.")
-                
-        elif function_name == 'play_playlist':
-            result = play_playlist(sp,function_args)
-            if result:  
-                output(role="system", content="OK I successfully started the playlist.")
-            else:
-                output(role="system", content="I wasn't able to start playback. Please check the playlist name and ensure Spotify is running on this device.") 
-      
-                
-        elif function_name == "reset": #reset and clear all messages
-            st.session_state.messages = []
-            st.session_state.messages.append({"role": "system", "content": background})
-        
-    
-    
+            with st.chat_message("user"):
+                st.markdown(prompt)
+            chat.run_turn(sp, openai_client, st.session_state.messages, prompt, config["chatbot"],
+                          entities=st.session_state["entities"], view=StreamlitView(),
+                          recent_tools=st.session_state.setdefault("recent_tools", []))
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tracing, metrics and logging for the chatbot.
+
+Each chat turn gets a trace id. span() times one stage of it (the LLM
+request, a Spotify call, rendering) and writes a JSON line per span to the
+trace file. Span durations and counters (API calls, tokens, cache hits) are
+also kept in memory and served in the Prometheus text format by
+start_metrics_server().
+
+Modules log through logging.getLogger('spotibot.<module>'). DEBUG records
+are sampled, so detailed logging can be left on in production.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('spotibot')
+
+_trace_id = contextvars.ContextVar('trace_id', default=None)
+_lock = threading.Lock()
+_counters = defaultdict(float)    # (name, labels) -> value
+_durations = defaultdict(lambda: [0, 0.0])   # (span name, labels) -> [count, total seconds]
+_collectors = {}                  # name -> function returning {stat: number}, read at scrape time
+_trace_file = None
+_server = None
+
+class SampleFilter(logging.Filter):
+    """Let through every record at INFO and above, and a fraction of DEBUG ones."""
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+def configure(level='INFO', debug_sample_rate=0.1, trace_path=None, metrics_port=None):
+    """Set up logging, the JSONL trace file and the metrics endpoint. Safe to call on every rerun."""
+    global _trace_file
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        handler.addFilter(SampleFilter(debug_sample_rate))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+    with _lock:
+        if trace_path and _trace_file is None:
+            _trace_file = open(trace_path, 'a', buffering=1)
+    if metrics_port:
+        start_metrics_server(metrics_port)
+
+def get_logger(name):
+    return logging.getLogger(f'spotibot.{name}')
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def incr(name, value=1, **labels):
+    with _lock:
+        _counters[_key(name, labels)] += value
+
+def collect(name, func):
+    """Export the numbers func() returns (e.g. a cache's stats dict) as spotibot_<name>_<stat> gauges."""
+    _collectors[name] = func
+
+def _emit(record):
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.write(json.dumps(record) + '\n')
+
+def observe(name, seconds, status='ok', **labels):
+    """Record a span that was timed elsewhere."""
+    with _lock:
+        entry = _durations[_key(name, labels)]
+        entry[0] += 1
+        entry[1] += seconds
+    _emit({'trace_id': _trace_id.get(), 'span': name, 'start': time.time() - seconds, 'seconds': round(seconds, 6),
+           'status': status, **labels})
+
+@contextlib.contextmanager
+def span(name, **labels):
+    """Time a stage of the current turn. labels become Prometheus labels, so keep them low-cardinality."""
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield
+    except Exception:
+        status = 'error'
+        raise
+    finally:
+        observe(name, time.perf_counter() - started, status, **labels)
+
+@contextlib.contextmanager
+def turn(**labels):
+    """A chat turn: a new trace id for every span inside it."""
+    token = _trace_id.set(uuid.uuid4().hex[:16])
+    try:
+        with span('turn', **labels):
+            yield _trace_id.get()
+    finally:
+        _trace_id.reset(token)
+
+def current_trace():
+    return _trace_id.get()
+
+def set_trace(trace_id):
+    """Adopt a trace id in a context propagate() can't reach, e.g. a task on another thread's event loop."""
+    _trace_id.set(trace_id)
+
+def propagate(func):
+    """Wrap func so it runs with the caller's trace id, e.g. on a thread pool."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+def record_usage(usage):
+    """Count the tokens reported in an OpenAI response's usage."""
+    if usage is None:
+        return
+    incr('llm_input_tokens_total', getattr(usage, 'input_tokens', 0) or 0)
+    incr('llm_output_tokens_total', getattr(usage, 'output_tokens', 0) or 0)
+
+_ID_SEGMENT = re.compile(r'/[0-9A-Za-z]{22}(?=/|$)')
+
+def endpoint(url):
+    """Spotify URL path with IDs replaced, for use as a metric label."""
+    path = url.split('api.spotify.com/v1', 1)[-1].split('?', 1)[0]
+    return _ID_SEGMENT.sub('/{id}', path)
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        counters = dict(_counters)
+        durations = {k: list(v) for k, v in _durations.items()}
+    for name in sorted({n for n, _ in counters}):
+        lines.append(f'# TYPE spotibot_{name} counter')
+        for (n, labels), value in counters.items():
+            if n == name:
+                lines.append(f'spotibot_{name}{_labels(labels)} {value}')
+    lines.append('# TYPE spotibot_span_seconds summary')
+    for (name, labels), (count, total) in sorted(durations.items()):
+        all_labels = (('span', name),) + labels
+        lines.append(f'spotibot_span_seconds_count{_labels(all_labels)} {count}')
+        lines.append(f'spotibot_span_seconds_sum{_labels(all_labels)} {total:.6f}')
+    for name, func in sorted(_collectors.items()):
+        for stat, value in func().items():
+            if isinstance(value, (int, float)):
+                lines.append(f'# TYPE spotibot_{name}_{stat} gauge')
+                lines.append(f'spotibot_{name}_{stat} {value}')
+    return '\n'.join(lines) + '\n'
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    """Serve /metrics on port from a daemon thread, once per process."""
+    global _server
+    with _lock:
+        if _server is not None:
+            return
+        try:
+            _server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+        except OSError as e:   # e.g. another process already serves it
+            logger.warning('metrics endpoint not started: %s', e)
+            return
+    threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
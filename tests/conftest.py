@@ -0,0 +1,43 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+import playlist_index
+from benchmark import FakeSpotify
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    cache.entity_cache.clear()
+    playlist_index._indexes.clear()
+    yield
+    cache.response_cache = None
+
+@pytest.fixture
+def sp():
+    return FakeSpotify()
+
+def text_reply(text):
+    """A Responses API response with one text message."""
+    return SimpleNamespace(output=[SimpleNamespace(type='message', content=[SimpleNamespace(text=text)])], usage=None)
+
+def calls_reply(*calls):
+    """A Responses API response with a function call per (name, args)."""
+    return SimpleNamespace(output=[SimpleNamespace(type='function_call', call_id=f'call{i}', name=name, arguments=args)
+                                   for i, (name, args) in enumerate(calls)], usage=None)
+
+class FakeOpenAI:
+    """Answers responses.create() with the given replies in turn and records every request."""
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.responses = self
+
+    def create(self, **kwargs):
+        self.requests.append(kwargs)
+        return self.replies.pop(0)
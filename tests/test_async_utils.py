@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+from spotipy.exceptions import SpotifyException
+
+import async_utils
+from entities import EntityMemory
+from ratelimit import TokenBucket
+
+class FakeWebAPI:
+    """Answers the Web API requests AsyncSpotify sends, over httpx.MockTransport."""
+    def __init__(self, playlists=3, rate_limit=None):
+        self.playlists = [{'name': f'Playlist {i}', 'id': f'pl{i}'} for i in range(playlists)]
+        self.rate_limit = rate_limit   # Retry-After of a 429 for the first request, if any
+        self.requests = []
+
+    def __call__(self, request):
+        path = request.url.path.removeprefix('/v1/')
+        self.requests.append((request.method, path))
+        if self.rate_limit is not None and len(self.requests) == 1:
+            return httpx.Response(429, headers={'Retry-After': self.rate_limit})
+        if path == 'search':
+            q = request.url.params['q']
+            return httpx.Response(200, json={'tracks': {'total': 1, 'items': [
+                {'id': f'id-{abs(hash(q))}', 'name': q, 'album': {'artists': [{'name': 'Artist'}]}}]}})
+        if path == 'me':
+            return httpx.Response(200, json={'id': 'user'})
+        if path == 'me/playlists':
+            offset, limit = int(request.url.params['offset']), int(request.url.params['limit'])
+            return httpx.Response(200, json={'items': self.playlists[offset:offset + limit], 'total': len(self.playlists)})
+        if path == 'users/user/playlists':
+            return httpx.Response(201, json={'id': 'new', 'name': json.loads(request.content)['name']})
+        if path.endswith('/tracks') and request.method == 'GET':
+            return httpx.Response(200, json={'items': [], 'total': 0})
+        if path.endswith('/tracks'):
+            return httpx.Response(201, json={'snapshot_id': 'snap'})
+        return httpx.Response(404)
+
+def run(web, func, *args, max_pause=30):
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(web)) as client:
+            return await func(async_utils.AsyncSpotify(client, 'token', TokenBucket(1000, 1000, max_pause)), *args)
+    return asyncio.run(main())
+
+ARGS = {'tracks': [{'track_name': f'Song {i}', 'artist': 'Artist'} for i in range(3)], 'playlist_name': 'Playlist 1'}
+
+def test_new_playlist_does_not_list_playlists():
+    web = FakeWebAPI()
+    assert run(web, async_utils.aadd_items_to_playlist, dict(ARGS, new_flag=True))
+    assert ('GET', 'me/playlists') not in web.requests
+    assert ('POST', 'playlists/new/tracks') in web.requests
+
+def test_existing_playlist_does_not_read_the_profile():
+    web = FakeWebAPI()
+    assert run(web, async_utils.aadd_items_to_playlist, dict(ARGS, new_flag=False))
+    assert ('GET', 'me') not in web.requests
+    assert ('POST', 'playlists/pl1/tracks') in web.requests
+
+def test_track_list_in_order_without_searching_listed_ids():
+    entities = EntityMemory()
+    entities.remember([('Song 1', '4uLU6hMCjMI75M1A2tKUQC')], 'Artist')
+    web = FakeWebAPI()
+    ids, tracks, unresolved = run(web, async_utils.acreate_track_list, ARGS, 8, 15, entities)
+    assert ids[1] == '4uLU6hMCjMI75M1A2tKUQC'
+    assert [name for track_id, artist, name in tracks] == ['track:Song 0 artist:Artist', 'Song 1', 'track:Song 2 artist:Artist']
+    assert [method for method, path in web.requests].count('GET') == 2
+
+def test_every_page_is_read():
+    web = FakeWebAPI(playlists=120)
+    items = run(web, lambda api: api.all_items('me/playlists', 50))
+    assert [p['id'] for p in items] == [f'pl{i}' for i in range(120)]
+    assert len(web.requests) == 3
+
+def test_429_is_retried():
+    web = FakeWebAPI(rate_limit='0.01')
+    assert run(web, lambda api: api.current_user()) == {'id': 'user'}
+    assert web.requests == [('GET', 'me'), ('GET', 'me')]
+
+@pytest.mark.parametrize('retry_after', ['3600', 'soon'])
+def test_429_that_would_wait_too_long_is_raised(retry_after):
+    web = FakeWebAPI(rate_limit=retry_after)
+    with pytest.raises(SpotifyException) as e:
+        run(web, lambda api: api.current_user(), max_pause=0.5)
+    assert e.value.http_status == 429
+    assert len(web.requests) == 1
@@ -0,0 +1,27 @@
+import cache
+
+def test_negative_results_are_cached():
+    entity_cache = cache.make_entity_cache()
+    fetched = []
+    def fetch():
+        fetched.append(1)
+        return None
+    assert entity_cache.lookup('track', 'Nothing', 'Nobody', fetch) is None
+    assert entity_cache.lookup('track', 'nothing ', 'NOBODY', fetch) is None
+    assert len(fetched) == 1
+
+def test_sqlite_tier_outlives_memory(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache.make_entity_cache(path).lookup('track', 'Yesterday', 'The Beatles', lambda: ['id1', 'The Beatles', 'Yesterday'])
+    again = cache.make_entity_cache(path)
+    assert again.lookup('track', 'Yesterday', 'The Beatles', lambda: None) == ['id1', 'The Beatles', 'Yesterday']
+
+def test_response_store_then_lookup_hits():
+    response_cache = cache.make_response_cache()
+    messages = [{'role': 'system', 'content': 'background'}, {'role': 'user', 'content': 'Who wrote Hey Jude?'}]
+    key = response_cache.key(messages, 'model', 0.3)
+    assert response_cache.lookup(key) is None
+    response_cache.store(key, 'Paul McCartney.', 1.5)
+    assert response_cache.lookup(response_cache.key(list(messages), 'model', 0.3)) == 'Paul McCartney.'
+    assert response_cache.lookup(response_cache.key(messages, 'other model', 0.3)) is None
+    assert response_cache.stats['seconds_saved'] == 1.5
@@ -0,0 +1,49 @@
+import json
+from types import SimpleNamespace
+
+import cache
+import chat
+from conftest import FakeOpenAI, calls_reply, text_reply
+
+SETTINGS = {'stream': False, 'token_budget': 4000, 'keep_recent': 6, 'fast_path': False,
+            'intent_threshold': 0.8, 'tool_selection': True}
+
+def test_cached_answer_is_reused(sp):
+    cache.response_cache = cache.make_response_cache()
+    client = FakeOpenAI(text_reply('Paul McCartney.'))
+    for i in range(2):
+        messages = chat.new_conversation()
+        chat.run_turn(sp, client, messages, 'Who wrote Hey Jude?', SETTINGS)
+        assert messages[-1]['content'] == 'Paul McCartney.'
+    assert len(client.requests) == 1
+    assert cache.response_cache.stats['hits'] == 1
+
+def test_follow_up_sends_each_result_once(sp):
+    client = FakeOpenAI(calls_reply(('top_tracks', json.dumps({'artist_name': 'Queen'})), ('get_playlists', '{}')),
+                        text_reply('Here you go.'))
+    messages = chat.new_conversation()
+    results = chat.run_turn(sp, client, messages, 'top Queen tracks and my playlists', SETTINGS)
+    assert len(results) == 2
+    assert all(result.ok for call, result in results)
+    followup = client.requests[1]['input']
+    assert followup[:2] == messages[:2]
+    assert [item['type'] for item in followup[2:]] == ['function_call', 'function_call_output'] * 2
+    assert messages[-1]['content'] == 'Here you go.'
+
+def test_simple_command_skips_the_model(sp):
+    client = FakeOpenAI()
+    messages = chat.new_conversation()
+    results = chat.run_turn(sp, client, messages, 'pause please', dict(SETTINGS, fast_path=True))
+    assert [(call['name'], result.ok) for call, result in results] == [('pause', True)]
+    assert sp.calls['pause_playback'] == 1
+    assert client.requests == []
+
+def broken_stream():
+    yield SimpleNamespace(type='response.output_text.delta', delta='Paul')
+    raise ConnectionError('connection reset')
+
+def test_stream_that_breaks_off_is_answered(sp):
+    client = FakeOpenAI(broken_stream())
+    messages = chat.new_conversation()
+    assert chat.run_turn(sp, client, messages, 'Who wrote Hey Jude?', dict(SETTINGS, stream=True)) == []
+    assert messages[-1]['content'] == chat.UNREACHABLE
@@ -0,0 +1,32 @@
+from context import SUMMARY_ITEMS, compact_messages, summarize_dump
+from registry import listing_history
+
+ID = 'x' * 21
+
+def test_under_budget_is_a_copy():
+    messages = [{'role': 'system', 'content': 'background'}, {'role': 'user', 'content': 'hi'}]
+    compacted, report = compact_messages(messages, budget=1000)
+    assert compacted == messages
+    messages.append({'role': 'system', 'content': 'answer'})
+    assert len(compacted) == 2
+    assert report['dropped'] == 0
+
+def test_summary_keeps_every_id():
+    items = [(f'Song {i}', f'{ID}{i % 10}') for i in range(SUMMARY_ITEMS + 5)]
+    msg = {'role': 'system', 'content': listing_history("These are the tracks", items)}
+    content = summarize_dump(msg)['content']
+    assert f'({SUMMARY_ITEMS + 5} in total)' in content
+    assert 'Song 0' in content and 'Song 14' not in content
+    assert 'and 5 more, by track ID: ' in content
+    for name, track_id in items[SUMMARY_ITEMS:]:
+        assert track_id in content
+
+def test_over_budget_keeps_recent_and_drops_oldest():
+    listing = {'role': 'system', 'content': listing_history("These are the tracks", [(f'Song {i}', f'{ID}{i % 10}') for i in range(200)])}
+    messages = ([{'role': 'system', 'content': 'background'}, listing]
+                + [{'role': 'user', 'content': f'prompt {i} ' * 50} for i in range(8)])
+    compacted, report = compact_messages(messages, budget=700, keep_recent=2)
+    assert compacted[0] == messages[0]
+    assert compacted[-2:] == messages[-2:]
+    assert report['after'] <= 700 < report['before']
+    assert report['dropped'] > 0
@@ -0,0 +1,39 @@
+from entities import EntityMemory
+
+def test_resolve_by_name_and_artist():
+    memory = EntityMemory()
+    memory.remember([('Yesterday', 'id1'), ('Help!', 'id2')], 'The Beatles')
+    assert memory.resolve('yesterday', 'the beatles') == ('id1', 'the beatles', 'Yesterday')
+    assert memory.resolve('Yesterday', 'Someone Else') is None
+
+def test_remaster_suffix_and_exact_name():
+    memory = EntityMemory()
+    memory.remember([('Yesterday - Remastered 2009', 'id1')], 'The Beatles')
+    assert memory.resolve('Yesterday', 'The Beatles')[0] == 'id1'
+    memory.remember([('Yesterday', 'id2')], 'The Beatles')
+    assert memory.resolve('Yesterday', 'The Beatles')[0] == 'id2'
+
+def test_oldest_dropped_first():
+    memory = EntityMemory(max_size=2)
+    memory.remember([('One', 'id1'), ('Two', 'id2'), ('Three', 'id3')])
+    assert len(memory) == 2
+    assert memory.get('id1') is None
+    assert memory.resolve('One', 'Anyone') is None
+    assert memory.get('id3') == ('Three', None)
+
+def test_dump_and_load():
+    memory = EntityMemory()
+    memory.remember([('Yesterday', 'id1')], 'The Beatles')
+    assert EntityMemory.load(memory.dump()).dump() == memory.dump()
+
+def test_track_without_artist_only_for_a_rec_without_one():
+    memory = EntityMemory()
+    memory.remember([('Yesterday', 'id1')])
+    assert memory.resolve('Yesterday', 'Leona Lewis') is None
+    assert memory.resolve('Yesterday', '')[0] == 'id1'
+
+def test_triples_keep_their_own_artist():
+    memory = EntityMemory()
+    memory.remember([('Yesterday', 'id1', 'The Beatles'), ('Yesterday', 'id2', 'Leona Lewis')])
+    assert memory.resolve('Yesterday', 'Leona Lewis')[0] == 'id2'
+    assert memory.resolve('Yesterday', 'The Beatles')[0] == 'id1'
@@ -0,0 +1,49 @@
+import json
+
+from benchmark import FakeSpotify
+import importer
+
+def rows(n):
+    return [{'track_name': f'Song {i}', 'artist': 'Artist'} for i in range(n)]
+
+def new_state():
+    return {'rows_done': 0, 'added': 0, 'duplicates': 0, 'unresolved': 0}
+
+def test_slow_searches_are_not_unresolved():
+    # an import waits for every search, however slow; only the chatbot's track lists have a deadline
+    sp = FakeSpotify(latency=0.02)
+    state = importer.import_tracks(sp, rows(20), 'pl0', new_state(), report=lambda line: None)
+    assert state['done']
+    assert state['added'] == 20
+    assert state['unresolved'] == 0
+
+class FailingSpotify(FakeSpotify):
+    def search(self, q, type='track', limit=10):
+        if 'Song 7' in q:
+            raise ConnectionError('connection reset')
+        return super().search(q, type, limit)
+
+def test_failed_search_stops_at_its_row(tmp_path):
+    checkpoint = str(tmp_path / 'import.json')
+    sp = FailingSpotify()
+    state = importer.import_tracks(sp, rows(12), 'pl0', new_state(), checkpoint_path=checkpoint,
+                                   batch_size=5, report=lambda line: None)
+    assert 'done' not in state
+    assert state['rows_done'] == 7
+    assert state['added'] == 7
+    assert json.load(open(checkpoint)) == state
+
+def test_blank_rows_are_not_counted_as_not_found(tmp_path):
+    unresolved_path = str(tmp_path / 'import.unresolved.jsonl')
+    class Missing(FakeSpotify):
+        def search(self, q, type='track', limit=10):
+            if 'Song 1 ' in q:
+                self._call('search')
+                return {'tracks': {'total': 0, 'items': []}}
+            return super().search(q, type, limit)
+    state = importer.import_tracks(Missing(), [None] + rows(3) + [None], 'pl0', new_state(),
+                                   unresolved_path=unresolved_path, report=lambda line: None)
+    assert state['blank'] == 2
+    assert state['unresolved'] == 1
+    assert state['added'] == 2
+    assert [json.loads(line) for line in open(unresolved_path)] == [{'track_name': 'Song 1', 'artist': 'Artist'}]
@@ -0,0 +1,14 @@
+from intents import classify, fast_path
+
+def test_commands():
+    assert classify('pause please') == ('pause', 1.0)
+    assert classify('Clear the queue') == ('clear_queue', 1.0)
+    assert fast_path('resume play')['name'] == 'start'
+
+def test_questions_and_arguments_go_to_the_model():
+    assert fast_path('play some jazz by Miles Davis from the fifties') is None
+    assert fast_path('what is playing') is None
+
+def test_words_of_another_intent_are_not_ignored():
+    assert fast_path('play my playlists') is None
+    assert fast_path('pause the queue') is None
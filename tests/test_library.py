@@ -0,0 +1,37 @@
+import utils
+from library import LibraryMirror
+
+def test_tracks_are_fetched_again_only_when_the_snapshot_changes(tmp_path, sp):
+    mirror = LibraryMirror(str(tmp_path / 'library.sqlite'), ttl=60)
+    first = mirror.playlist_tracks(sp, 'pl1')
+    assert len(first) == 100 and first[0] == ('Track pl1-t0', 'pl1-t0', 'Artist')
+    assert mirror.playlist_tracks(sp, 'pl1') == first
+    assert sp.calls['playlist_tracks'] == 1
+    assert mirror.stats['track_hits'] == 1
+
+    sp.tracks['pl1'].pop()   # changed in another app
+    sp.playlists[1]['snapshot_id'] = 'elsewhere'
+    assert len(mirror.playlist_tracks(sp, 'pl1')) == 100   # the list is still within its ttl
+    mirror.invalidate(sp)
+    assert len(mirror.playlist_tracks(sp, 'pl1')) == 99
+    assert sp.calls['playlist_tracks'] == 2
+
+def test_our_writes_keep_the_mirror_in_step(tmp_path, sp, monkeypatch):
+    mirror = LibraryMirror(str(tmp_path / 'library.sqlite'), ttl=60)
+    monkeypatch.setattr(utils, 'library', mirror)
+    mirror.playlist_tracks(sp, 'pl1')
+    args = {'tracks': [{'track_name': 'Song', 'artist': 'Artist'}], 'playlist_name': 'Playlist 1', 'new_flag': False}
+    assert utils.add_items_to_playlist(sp, args)
+    mirror.invalidate(sp)   # the list Spotify sends now has the snapshot of our write
+    tracks = mirror.playlist_tracks(sp, 'pl1')
+    assert len(tracks) == 101 and tracks[-1][0] == 'track:Song artist:Artist'
+    assert sp.calls['playlist_tracks'] == 1
+
+def test_a_new_playlist_starts_empty(tmp_path, sp, monkeypatch):
+    mirror = LibraryMirror(str(tmp_path / 'library.sqlite'), ttl=60)
+    monkeypatch.setattr(utils, 'library', mirror)
+    args = {'tracks': [{'track_name': 'Song', 'artist': 'Artist'}], 'playlist_name': 'Brand new', 'new_flag': True}
+    assert utils.add_items_to_playlist(sp, args)
+    new_id = sp.playlists[-1]['id']
+    assert [name for name, track_id, artist in mirror.playlist_tracks(sp, new_id)] == ['track:Song artist:Artist']
+    assert sp.calls['playlist_tracks'] == 0
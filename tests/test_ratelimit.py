@@ -0,0 +1,54 @@
+import time
+
+import pytest
+from spotipy.exceptions import SpotifyException
+
+from benchmark import FakeSpotify
+from ratelimit import TokenBucket, retry_after
+
+def test_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(rate=50, capacity=5)
+    start = time.monotonic()
+    for i in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.05
+    for i in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.08
+
+def test_pause_holds_every_caller():
+    bucket = TokenBucket(rate=1000, capacity=1000)
+    bucket.pause(0.1)
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+    assert bucket.throttled == 1
+
+def test_429_is_retried_by_the_transport():
+    sp = FakeSpotify(rate_limit_every=2)
+    assert sp.current_user() == {'id': 'bench-user'}
+    assert sp.current_user() == {'id': 'bench-user'}
+    assert sp.calls['current_user'] == 3
+    assert sp.calls['429'] == 1
+    assert sp.session.bucket.throttled == 1
+
+def test_429_after_the_last_retry_raises():
+    sp = FakeSpotify(rate_limit_every=1)
+    with pytest.raises(SpotifyException) as e:
+        sp.current_user()
+    assert e.value.http_status == 429
+
+def test_long_retry_after_fails_instead_of_waiting():
+    sp = FakeSpotify(rate_limit_every=1, retry_after=3600)
+    start = time.monotonic()
+    with pytest.raises(SpotifyException) as e:
+        sp.current_user()
+    assert e.value.http_status == 429
+    assert time.monotonic() - start < 1
+    assert sp.calls['current_user'] == 1
+    assert sp.session.bucket.blocked_until == 0.0
+
+def test_retry_after_that_is_not_a_number():
+    assert retry_after({'Retry-After': 'Wed, 21 Oct 2026 07:28:00 GMT'}) == 1.0
+    assert retry_after({'Retry-After': '2'}) == 2.0
+    assert retry_after({}) == 1.0
@@ -0,0 +1,35 @@
+import time
+
+from registry import ToolRegistry, ToolResult
+
+def test_reads_after_a_write_see_it(sp):
+    import registry
+    calls = [{'name': 'add_to_playlist', 'args': {'tracks': [{'track_name': 'Song', 'artist': 'Artist'}],
+                                                 'playlist_name': 'Playlist 1', 'new_flag': False}},
+             {'name': 'playlist_tracks', 'args': {'playlist_name': 'Playlist 1'}}]
+    (add, added), (listing, listed) = registry.registry.run(sp, calls)
+    assert added.ok and listed.ok
+    assert len(listed.items) == 101
+
+def test_reads_before_the_first_write_run_concurrently():
+    tools = ToolRegistry()
+    order, running, peak = [], [], []
+    def read(sp, args, ctx):
+        running.append(1)
+        peak.append(len(running))
+        time.sleep(0.05)
+        running.pop()
+        order.append(args['n'])
+        return ToolResult(True)
+    def write(sp, args, ctx):
+        assert not running
+        order.append('write')
+        return ToolResult(True)
+    tools.register('read')(read)
+    tools.register('write', mutates=True)(write)
+    calls = [{'name': 'read', 'args': {'n': 1}}, {'name': 'read', 'args': {'n': 2}},
+             {'name': 'write', 'args': {}}, {'name': 'read', 'args': {'n': 3}}]
+    results = tools.run(None, calls)
+    assert [call['name'] for call, result in results] == ['read', 'read', 'write', 'read']
+    assert max(peak) == 2
+    assert order[2:] == ['write', 3]
@@ -0,0 +1,100 @@
+import asyncio
+import copy
+import json
+import threading
+import time
+
+import pytest
+
+import server
+import tokens
+from benchmark import FakeSpotify
+from conftest import FakeOpenAI, text_reply
+from entities import EntityMemory
+from server import SessionBusy, SessionStore
+
+def test_a_sid_is_held_by_one_process_at_a_time(tmp_path):
+    path = str(tmp_path / 'sessions.sqlite')
+    one, other = SessionStore(path), SessionStore(path)   # as two worker processes would open it
+    with one.hold('sid'):
+        with pytest.raises(SessionBusy):
+            with other.hold('sid'):
+                pass
+        with other.hold('another sid'):
+            pass
+    with other.hold('sid'):
+        other.save('sid', [{'role': 'system', 'content': 'hi'}], EntityMemory(), ['pause'])
+    assert one.load('sid')[2] == ['pause']
+
+def test_a_hold_expires(tmp_path):
+    path = str(tmp_path / 'sessions.sqlite')
+    crashed, other = SessionStore(path, lease=-1), SessionStore(path)
+    with crashed.hold('sid'):
+        with other.hold('sid'):
+            pass
+
+TOKEN = {'access_token': 'token', 'refresh_token': 'refresh', 'expires_at': time.time() + 3600}
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    config = copy.deepcopy(server.config)
+    config['token_store'].update(enabled=True, path=str(tmp_path / 'tokens.sqlite'))
+    config['chatbot']['stream'] = False
+    config['server'].update(workers=1, queue=0, per_sid=1, session_path=str(tmp_path / 'sessions.sqlite'))
+    monkeypatch.setattr(tokens, '_store', None)
+    monkeypatch.setattr(tokens, '_refresher', object())   # no refresher thread
+    service = server.ChatService(config)
+    for sid in ('sid', 'other'):
+        service.token_store.set(sid, TOKEN)
+    monkeypatch.setattr(server, 'service', service)
+    yield service
+    service.executor.shutdown(wait=False)
+
+async def request(method, path, body=None):
+    incoming = [{'type': 'http.request', 'body': json.dumps(body).encode() if body is not None else b''}]
+    sent = []
+    async def receive():
+        return incoming.pop(0)
+    async def send(message):
+        sent.append(message)
+    await server.app({'type': 'http', 'method': method, 'path': path}, receive, send)
+    return sent[0]['status'], dict(sent[0]['headers']), json.loads(sent[1]['body'])
+
+def test_turns_keep_their_conversation(service, monkeypatch):
+    sp = FakeSpotify()
+    monkeypatch.setattr(service, 'spotify', lambda sid: sp)
+    service._openai_client = FakeOpenAI(text_reply('Paul McCartney.'))
+    status, headers, reply = asyncio.run(request('POST', '/chat', {'sid': 'sid', 'prompt': 'Who wrote Hey Jude?'}))
+    assert status == 200
+    assert reply['messages'][-1]['content'] == 'Paul McCartney.'
+    status, headers, reply = asyncio.run(request('POST', '/chat', {'sid': 'sid', 'prompt': 'pause'}))
+    assert reply['results'][0]['name'] == 'pause'
+    messages, entities, recent_tools = service.sessions.load('sid')
+    assert [m['content'] for m in messages[1:]] == ['Who wrote Hey Jude?', 'Paul McCartney.', 'pause', 'OK I successfully paused playback.']
+    assert recent_tools == ['pause']
+
+def test_bad_requests(service):
+    assert asyncio.run(request('POST', '/chat', {'sid': 'nobody', 'prompt': 'hi'}))[0] == 401
+    assert asyncio.run(request('POST', '/chat', {'prompt': 'hi'}))[0] == 400
+    assert asyncio.run(request('GET', '/chat'))[0] == 404
+
+def test_busy_sid_gets_429_and_a_full_pool_503(service, monkeypatch):
+    release = threading.Event()
+    def turn(sid, prompt):
+        release.wait(5)
+        return {'messages': [], 'results': []}
+    monkeypatch.setattr(service, 'turn', turn)
+
+    async def main():
+        first = asyncio.ensure_future(request('POST', '/chat', {'sid': 'sid', 'prompt': 'one'}))
+        while service.pending == 0:
+            await asyncio.sleep(0.01)
+        same_sid = await request('POST', '/chat', {'sid': 'sid', 'prompt': 'two'})
+        other_sid = await request('POST', '/chat', {'sid': 'other', 'prompt': 'three'})
+        release.set()
+        return await first, same_sid, other_sid
+    first, same_sid, other_sid = asyncio.run(main())
+    assert first[0] == 200
+    assert same_sid[0] == 429 and same_sid[1][b'retry-after'] == b'1'
+    assert other_sid[0] == 503 and other_sid[1][b'retry-after'] == b'1'
+    assert not service._sids
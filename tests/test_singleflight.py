@@ -0,0 +1,74 @@
+import threading
+import time
+
+import pytest
+
+from singleflight import SingleFlight
+
+def test_do_collapses_concurrent_calls():
+    flights = SingleFlight()
+    calls = []
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return 'value'
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do('search', 'key', slow))) for i in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ['value'] * 5
+    assert len(calls) == 1
+    assert flights.stats['collapsed'] == 4
+    assert not flights._flights
+
+def test_do_shares_the_error():
+    flights = SingleFlight()
+    started = threading.Event()
+    def fail():
+        started.set()
+        time.sleep(0.1)
+        raise ValueError('boom')
+    errors = []
+    def call():
+        try:
+            flights.do('search', 'key', fail)
+        except ValueError as e:
+            errors.append(e)
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    call()
+    leader.join()
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+
+def test_stream_is_read_in_full_by_a_late_reader():
+    flights = SingleFlight()
+    first, shared = flights.stream('llm_stream', 'key', lambda: iter([1, 2, 3]))
+    assert not shared
+    assert next(first) == 1
+    second, shared = flights.stream('llm_stream', 'key', lambda: pytest.fail('sent twice'))
+    assert shared
+    assert list(first) == [2, 3]
+    assert list(second) == [1, 2, 3]
+
+def test_abandoned_stream_is_not_joined():
+    flights = SingleFlight()
+    first, shared = flights.stream('llm_stream', 'key', lambda: iter([1, 2, 3]))
+    next(first)
+    first.close()   # the leader stopped reading, e.g. a Streamlit rerun
+    assert not flights._streams
+    second, shared = flights.stream('llm_stream', 'key', lambda: iter([4]))
+    assert not shared
+    assert list(second) == [4]
+
+def test_stale_stream_is_not_joined(monkeypatch):
+    flights = SingleFlight()
+    first, shared = flights.stream('llm_stream', 'key', lambda: iter([1]))
+    next(first)
+    monkeypatch.setattr('singleflight.STREAM_JOIN_WINDOW', 0)
+    second, shared = flights.stream('llm_stream', 'key', lambda: iter([2]))
+    assert not shared
+    assert list(second) == [2]
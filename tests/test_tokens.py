@@ -0,0 +1,57 @@
+import time
+
+import tokens
+from tokens import TokenStore, refresh_due
+
+def token(name, expires_in):
+    return {'access_token': name, 'refresh_token': f'refresh-{name}', 'expires_at': time.time() + expires_in}
+
+def test_a_renewal_in_another_process_is_picked_up(tmp_path):
+    path = str(tmp_path / 'tokens.sqlite')
+    app, server = TokenStore(path), TokenStore(path)   # as the Streamlit app and server.py would open it
+    app.set('sid', token('old', 100))
+    assert server.get('sid')['access_token'] == 'old'
+    refresh_due(app, lambda refresh_token: token('new', 3600))
+    assert server.get('sid')['access_token'] == 'new'
+
+def test_a_token_is_renewed_by_one_process(tmp_path):
+    path = str(tmp_path / 'tokens.sqlite')
+    one, other = TokenStore(path), TokenStore(path)
+    one.set('sid', token('old', 100))
+    used = []
+    def refresh(refresh_token):
+        used.append(refresh_token)
+        assert other.claim_refresh('sid', time.time() + 300) is False   # a refresher in another process skips it
+        return token('new', 3600)
+    refresh_due(one, refresh)
+    refresh_due(other, refresh)
+    assert used == ['refresh-old']
+
+def test_unused_logins_are_deleted(tmp_path):
+    path = str(tmp_path / 'tokens.sqlite')
+    store, other = TokenStore(path), TokenStore(path)
+    store.set('sid', token('old', 100))
+    store.set('recent', token('recent', 3600))
+    assert other.get('sid')
+    store._conn.execute("UPDATE tokens SET used_at = 0 WHERE sid = 'sid'")   # last used long ago
+    store._conn.commit()
+    refresh_due(store, lambda refresh_token: token('new', 3600))
+    assert store.get('sid') is None
+    assert other.get('sid') is None
+    assert store.get('recent')['access_token'] == 'recent'
+
+def test_oauth_state_is_accepted_once():
+    state = tokens.new_oauth_state()
+    assert tokens.check_oauth_state(state)
+    assert not tokens.check_oauth_state(state)
+
+def test_unknown_or_expired_oauth_state_is_refused(monkeypatch):
+    assert not tokens.check_oauth_state('chosen-by-someone-else')
+    assert not tokens.check_oauth_state(None)
+    monkeypatch.setattr(tokens, 'OAUTH_STATE_TTL', -1)
+    assert not tokens.check_oauth_state(tokens.new_oauth_state())
+
+def test_session_ids_are_not_guessable(tmp_path):
+    assert len({tokens.new_session_id() for i in range(100)}) == 100
+    assert len(tokens.new_session_id()) >= 32
+    assert TokenStore(str(tmp_path / 'tokens.sqlite')).get(tokens.new_session_id()) is None
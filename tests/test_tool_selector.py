@@ -0,0 +1,20 @@
+from tool_selector import select_tools
+
+def groups(prompt, recent_tools=()):
+    return select_tools(prompt, recent_tools)[2]
+
+def test_keywords_pick_groups():
+    assert 'queue' in groups('add some jazz to the queue')
+
+def test_trivia_needs_no_tools():
+    assert groups('who wrote Hey Jude') == ['session']
+    assert groups('tell me about the Beatles') == ['session']
+
+def test_questions_about_the_account_get_every_tool():
+    assert groups('what is on my Discover Weekly') is None
+    assert groups('who is in my Road Trip list') is None
+    assert groups('what is this song') is None
+
+def test_follow_up_uses_recent_tools():
+    assert groups('who sings that', ['top_tracks']) is not None
+    assert groups('why', ['top_tracks']) is None
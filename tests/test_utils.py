@@ -0,0 +1,53 @@
+from benchmark import FakeSpotify
+import utils
+
+def test_paginate_reads_every_page(sp):
+    sp.playlist_size = 250
+    page = sp.playlist_tracks('big2', limit=100)
+    items = list(utils.paginate(sp, page))
+    assert len(items) == 250
+    assert [i['track']['id'] for i in items] == [f'big2-t{i}' for i in range(250)]
+    assert sp.calls['next'] == 2
+
+def test_resolve_tracks_in_order_with_429s():
+    sp = FakeSpotify(rate_limit_every=4)
+    recs = [{'track_name': f'Song {i}', 'artist': 'Artist'} for i in range(20)]
+    ids, tracks, unresolved = utils.create_track_list(sp, {'tracks': recs})
+    assert [name for track_id, artist, name in tracks] == [f'track:Song {i} artist:Artist' for i in range(20)]
+    assert not unresolved
+    assert sp.calls['429'] > 0
+
+def test_listed_id_needs_no_search(sp):
+    rec = {'track_name': 'Song', 'artist': 'Artist', 'track_id': '4uLU6hMCjMI75M1A2tKUQC'}
+    assert utils.find_track(sp, rec) == ('4uLU6hMCjMI75M1A2tKUQC', 'Artist', 'Song')
+    assert sp.calls['search'] == 0
+
+def test_skip_is_the_default(sp):
+    report = utils.reset_queue(sp)
+    assert report['strategy'] == 'skip'
+    assert report['calls'] == report['queue_length'] - 1 + 3   # the skips, plus reading devices, player and queue
+
+def test_restart_clears_what_the_user_queued(sp):
+    report = utils.reset_queue(sp, 'restart')
+    assert report['cleared']
+    assert sp.queue_items == []
+    assert sp.current['item']['id'] == 'now'
+    assert sp.current['progress_ms'] == 1000
+
+def test_playlist_writes_need_the_exact_name(sp):
+    args = {'tracks': [{'track_name': 'Song', 'artist': 'Artist'}], 'new_flag': False}
+    assert not utils.add_items_to_playlist(sp, dict(args, playlist_name='Playlist'))
+    assert sp.calls['playlist_add_items'] == 0
+    assert utils.add_items_to_playlist(sp, dict(args, playlist_name='playlist 3'))
+    assert sp.calls['playlist_add_items'] == 1
+
+def test_playlist_listing_remembers_each_artist(sp):
+    import registry
+    from entities import EntityMemory
+    entities = EntityMemory()
+    result = registry.registry.run(sp, [{'name': 'playlist_tracks', 'args': {'playlist_name': 'Playlist 1'}}],
+                                   {'entities': entities})[0][1]
+    assert result.ok
+    assert result.items[0] == ('Track pl1-t0', 'pl1-t0')
+    assert utils.known_track({'track_name': 'Track pl1-t0', 'artist': 'Artist'}, entities)[0] == 'pl1-t0'
+    assert utils.known_track({'track_name': 'Track pl1-t0', 'artist': 'Someone Else'}, entities) is None
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spotify OAuth tokens kept outside st.session_state.
+
+A TokenStore keeps each browser session's token in SQLite, keyed by an
+opaque session id that the app mints after a successful login and puts in
+the URL (?sid=...). A new browser session that brings the same sid back is
+logged in without the OAuth redirect. The OAuth state parameter is only a
+CSRF check: new_oauth_state() issues one per login attempt and
+check_oauth_state() accepts it once. Tokens are encrypted with Fernet when a key is configured (this
+needs the cryptography package).
+
+start_refresher() runs a daemon thread that renews tokens a few minutes
+before they expire, so the refresh never happens inside a user's command.
+Every process that shares the database (the Streamlit app, server.py
+workers) runs one; a process claims a token in SQLite before renewing it,
+so a rotating refresh token is only used once. A process's in-memory copy
+of a token is read again from SQLite once it is close to expiry, which is
+when another process will have renewed it. Logins nobody has used for
+retention seconds are deleted instead of being renewed forever.
+"""
+
+import json
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+try:
+    from cryptography.fernet import Fernet
+except ImportError:  # only needed when tokens are encrypted
+    Fernet = None
+
+import telemetry
+
+log = telemetry.get_logger('tokens')
+
+REFRESH_MARGIN = 300     # seconds before expiry a token is renewed
+REFRESH_INTERVAL = 60    # seconds between checks
+REFRESH_HOLD = 60        # seconds a process's claim on a token it is renewing lasts
+RETENTION = 30*24*3600   # seconds a login may go unused before it is deleted
+USE_INTERVAL = 3600      # seconds between updates of a login's last use
+OAUTH_STATE_TTL = 600    # seconds a login attempt may take
+
+def new_session_id():
+    return secrets.token_urlsafe(24)
+
+_oauth_states = {}   # state -> expiry time, for logins that were started but have not come back yet
+_oauth_lock = threading.Lock()
+
+def new_oauth_state():
+    """A one-time state value for the authorize URL."""
+    state = secrets.token_urlsafe(24)
+    now = time.time()
+    with _oauth_lock:
+        for old in [s for s, expires_at in _oauth_states.items() if expires_at < now]:
+            del _oauth_states[old]
+        _oauth_states[state] = now + OAUTH_STATE_TTL
+    return state
+
+def check_oauth_state(state):
+    """True if state was issued by new_oauth_state(), has not expired and has not been used before."""
+    with _oauth_lock:
+        expires_at = _oauth_states.pop(state, None) if state else None
+    return expires_at is not None and expires_at > time.time()
+
+class TokenStore:
+    """Thread-safe sid -> token_info store with an in-memory copy in front of SQLite.
+    The copy is trusted until margin seconds before the token expires."""
+
+    def __init__(self, path, key=None, margin=REFRESH_MARGIN):
+        if key and Fernet is None:
+            raise RuntimeError("Encrypting the token store needs the cryptography package")
+        self._fernet = Fernet(key) if key else None
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._memory = {}   # sid -> [token_info, updated_at, used_at]
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS tokens (sid TEXT PRIMARY KEY, token TEXT, expires_at REAL, updated_at REAL, "
+                           "used_at REAL, refreshing_until REAL)")
+        for column in ('used_at', 'refreshing_until'):
+            try:   # tables from before logins expired and refreshes were claimed
+                self._conn.execute(f"ALTER TABLE tokens ADD COLUMN {column} REAL")
+            except sqlite3.OperationalError:
+                pass
+        self._conn.commit()
+
+    def _dump(self, token_info):
+        text = json.dumps(token_info)
+        return self._fernet.encrypt(text.encode()).decode() if self._fernet else text
+
+    def _load(self, text):
+        return json.loads(self._fernet.decrypt(text.encode()) if self._fernet else text)
+
+    def get(self, sid):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(sid)
+            if entry and entry[0].get('expires_at', 0) > now + self.margin:
+                if entry[2] < now - USE_INTERVAL:
+                    self._used(sid, entry, now)
+                return entry[0]
+        # not read yet, or due for renewal, which another process may have done
+        return self.reload(sid)
+
+    def reload(self, sid):
+        """The token as SQLite has it now, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT token, updated_at FROM tokens WHERE sid = ?", (sid,)).fetchone()
+            entry = self._memory.get(sid)
+            if row is None:   # deleted, perhaps by another process
+                self._memory.pop(sid, None)
+                return None
+            if entry and entry[1] >= row[1]:
+                return entry[0]
+        try:
+            token_info = self._load(row[0])
+        except Exception as e:   # e.g. written with another key
+            log.warning("Could not read the stored token: %r", e)
+            return None
+        with self._lock:
+            entry = self._memory[sid] = [token_info, row[1], 0]
+            self._used(sid, entry, now)
+        return token_info
+
+    def _used(self, sid, entry, now):
+        entry[2] = now
+        self._conn.execute("UPDATE tokens SET used_at = ? WHERE sid = ?", (now, sid))
+        self._conn.commit()
+
+    def set(self, sid, token_info):
+        now = time.time()
+        with self._lock:
+            self._memory[sid] = [token_info, now, now]
+            self._conn.execute("INSERT OR REPLACE INTO tokens (sid, token, expires_at, updated_at, used_at) VALUES (?, ?, ?, ?, ?)",
+                               (sid, self._dump(token_info), token_info.get('expires_at', 0), now, now))
+            self._conn.commit()
+
+    def delete(self, sid):
+        with self._lock:
+            self._memory.pop(sid, None)
+            self._conn.execute("DELETE FROM tokens WHERE sid = ?", (sid,))
+            self._conn.commit()
+
+    def expiring(self, before):
+        """sids of the tokens that expire before the given time."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT sid FROM tokens WHERE expires_at < ?", (before,))]
+
+    def claim_refresh(self, sid, before, hold=REFRESH_HOLD):
+        """True if this process may renew sid's token: it still expires before the given time and no
+        other process has claimed it in the last hold seconds. set() ends the claim."""
+        now = time.time()
+        with self._lock:
+            claimed = self._conn.execute("UPDATE tokens SET refreshing_until = ? WHERE sid = ? AND expires_at < ? "
+                                         "AND COALESCE(refreshing_until, 0) < ?", (now + hold, sid, before, now)).rowcount
+            self._conn.commit()
+        return bool(claimed)
+
+    def delete_unused(self, before):
+        """Delete the logins last used before the given time; returns how many there were."""
+        with self._lock:
+            sids = [row[0] for row in self._conn.execute("SELECT sid FROM tokens WHERE COALESCE(used_at, updated_at) < ?", (before,))]
+            for sid in sids:
+                self._memory.pop(sid, None)
+                self._conn.execute("DELETE FROM tokens WHERE sid = ?", (sid,))
+            self._conn.commit()
+        return len(sids)
+
+def refresh_due(store, refresh, margin=REFRESH_MARGIN, retention=RETENTION):
+    """Renew every token expiring within margin seconds, and delete logins unused for retention seconds.
+    refresh(refresh_token) returns the new token_info."""
+    now = time.time()
+    removed = store.delete_unused(now - retention)
+    if removed:
+        log.info("Deleted %d logins unused for %ds", removed, retention)
+        telemetry.incr('token_expired_total', removed)
+    for sid in store.expiring(now + margin):
+        if not store.claim_refresh(sid, now + margin):   # another process is renewing it, or just has
+            continue
+        token_info = store.reload(sid)
+        if not token_info or not token_info.get('refresh_token'):
+            store.delete(sid)
+            continue
+        try:
+            with telemetry.span('token_refresh'):
+                new_info = refresh(token_info['refresh_token'])
+        except Exception as e:
+            log.warning("Token refresh failed: %r", e)
+            telemetry.incr('token_refresh_total', status='error')
+            if getattr(e, 'error', None) == 'invalid_grant':   # revoked: the user has to log in again
+                store.delete(sid)
+            continue
+        new_info.setdefault('refresh_token', token_info['refresh_token'])
+        store.set(sid, new_info)
+        telemetry.incr('token_refresh_total', status='ok')
+
+_store = None
+_refresher = None
+_store_lock = threading.Lock()
+
+def get_token_store(path, key_env=None, refresh_margin=REFRESH_MARGIN, **ignored):
+    """Return the process-wide TokenStore, creating it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            key = os.environ.get(key_env) if key_env else None
+            if not key:
+                log.warning("Spotify tokens in %s are stored unencrypted; set %s to encrypt them", path, key_env)
+            _store = TokenStore(path, key, refresh_margin)
+        return _store
+
+def start_refresher(store, refresh, margin=REFRESH_MARGIN, interval=REFRESH_INTERVAL, retention=RETENTION):
+    """Start the background refresher once per process."""
+    global _refresher
+
+    def run():
+        while True:
+            try:
+                refresh_due(store, refresh, margin, retention)
+            except Exception as e:
+                log.warning("Token refresher: %r", e)
+            time.sleep(interval)
+
+    with _store_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=run, name='token-refresher', daemon=True)
+            _refresher.start()
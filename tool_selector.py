@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Picks the tools from tools.py worth sending with a prompt.
+
+The tools are split into a few fixed groups. A group is sent when the
+prompt mentions one of its keywords. A prompt with no keywords that refers
+back to earlier results ("do that again", "save them") gets the groups of
+the tools that ran recently plus the ones that act on listed tracks. A
+prompt that matches no group and is clearly general music trivia ("Who
+wrote Fame?", "Tell me about chillwave"), early in a conversation that
+hasn't used any tools, is sent with the session group only. Anything else
+that matches nothing gets the full list, so the model never loses a tool it
+might need: "What's on Communique by Dire Straits?" needs album_tracks
+without naming it.
+
+Subsets always keep the order of tools.py and are built once, so the same
+choice produces byte-identical tool JSON and the provider's prompt cache
+can reuse it.
+"""
+
+import json
+
+from cache import normalize
+from context import count_tokens
+from tools import tools
+
+GROUPS = {
+    'session': ['reset'],   # sent with every subset; it is tiny
+    'playback': ['pause', 'start', 'play_track', 'play_album', 'play_playlist'],
+    'queue': ['add_to_queue', 'clear_queue'],
+    'playlists': ['get_playlists', 'playlist_tracks', 'add_to_playlist', 'play_playlist'],
+    'lookup': ['top_tracks', 'album_tracks'],
+}
+
+KEYWORDS = {
+    'playback': {'play', 'pause', 'start', 'stop', 'resume', 'listen', 'unpause', 'continue'},
+    'queue': {'queue', 'queued', 'next'},
+    'playlists': {'playlist', 'playlists', 'save', 'make', 'create'},
+    'lookup': {'top', 'tracks', 'songs', 'album', 'albums', 'tracklist', 'popular', 'hits'},
+}
+
+# words that refer to something shown earlier in the conversation
+REFERENCES = {'those', 'them', 'these', 'that', 'this', 'it', 'they', 'all', 'same'}
+# groups a reference to earlier results can act on
+FOLLOW_UP_GROUPS = ('queue', 'playlists', 'playback')
+# openings of a general music question; "what", "which" and "how" also start requests about the user's music
+TRIVIA_WORDS = {'who', 'why', 'when', 'tell', 'explain', 'describe'}
+# words that point at the user's own library or player
+PERSONAL_WORDS = {'my', 'mine', 'me', 'i', 'im', 'our', 'on', 'in', 'from'}
+
+_subsets = {}   # frozenset of tool names -> (tool list, schema tokens)
+
+def _subset(names):
+    key = frozenset(names)
+    if key not in _subsets:
+        chosen = [t for t in tools if t['name'] in key]
+        _subsets[key] = chosen, count_tokens([{'content': json.dumps(chosen)}])
+    return _subsets[key]
+
+def full_set():
+    """(every tool, schema tokens)."""
+    return _subset(t['name'] for t in tools)
+
+def select_tools(prompt, recent_tools=()):
+    """(tools to send, schema tokens, chosen group names or None when falling back to every tool).
+    recent_tools are the names of the tools that ran in the last few turns."""
+    words = set(normalize(prompt).split())
+    groups = {name for name, keywords in KEYWORDS.items() if words & keywords}
+    if not groups and words & REFERENCES and recent_tools:
+        groups |= {name for name, members in GROUPS.items() if set(members) & set(recent_tools)}
+        groups |= set(FOLLOW_UP_GROUPS)
+    if not groups:
+        first = normalize(prompt).split()[:1]
+        trivia = first and first[0] in TRIVIA_WORDS and not (words - {'tell', 'me'}) & PERSONAL_WORDS
+        if recent_tools or not trivia:
+            chosen, tokens = full_set()
+            return chosen, tokens, None
+    groups.add('session')
+    names = [n for g in sorted(groups) for n in GROUPS[g]]
+    chosen, tokens = _subset(names)
+    return chosen, tokens, sorted(groups)
@@ -35,6 +35,10 @@ tools =[
                             "artist": {
                                 "type": "string",
                                 "description": "The artist that recorded the track or song."
+                            },
+                            "track_id": {
+                                "type": "string",
+                                "description": "The Spotify track ID, if the track was listed earlier in the conversation (the ID in its spotify:track: link)."
                             }
                         },
                         "required": ["track_name", "artist"]
@@ -65,6 +69,10 @@ tools =[
                             "artist": {
                                 "type": "string",
                                 "description": "The artist that recorded the track or song."
+                            },
+                            "track_id": {
+                                "type": "string",
+                                "description": "The Spotify track ID, if the track was listed earlier in the conversation (the ID in its spotify:track: link)."
                             }
                         },
                         "required": ["track_name", "artist"]
@@ -181,6 +189,10 @@ tools =[
                           "artist": {
                               "type": "string",
                               "description": "The artist that recorded the track or song."
+                          },
+                          "track_id": {
+                              "type": "string",
+                              "description": "The Spotify track ID, if the track was listed earlier in the conversation (the ID in its spotify:track: link)."
                           }
                       },
                       "required": ["track_name", "artist"]
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+One HTTP session shared by every Spotify client in the process.
+
+Each Streamlit session gets its own Spotify object, but they all send their
+requests through the same keep-alive connection pool. A process-wide token
+bucket spaces out requests, and a 429 from Spotify pauses every session
+for the Retry-After period, not just the one that got it. A Retry-After
+over max_pause is returned to the caller as the 429 (spotipy raises it as
+a SpotifyException) instead of stalling every session.
+"""
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import telemetry
+from ratelimit import MAX_PAUSE, TokenBucket, retry_after
+
+log = telemetry.get_logger('transport')
+
+POOL_CONNECTIONS = 10   # hosts to keep pools for
+POOL_MAXSIZE = 50       # connections kept per host
+REQUEST_TIMEOUT = 10    # seconds, passed to Spotify(requests_timeout=...)
+MAX_RETRIES = 3         # for connection errors and 5xx responses
+MAX_429_RETRIES = 3
+RATE = 20               # requests per second across all sessions
+BURST = 20
+
+class RateLimitedSession(requests.Session):
+    def __init__(self, bucket, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                 max_retries=MAX_RETRIES, max_429_retries=MAX_429_RETRIES):
+        super().__init__()
+        # same retry policy spotipy uses for its own sessions, minus 429 which is handled below
+        retry = Retry(total=max_retries, connect=None, read=False, allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                      status=max_retries, backoff_factor=0.3, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        self.bucket = bucket
+        self.max_429_retries = max_429_retries
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'in_flight': 0, 'max_in_flight': 0, 'errors': 0, 'seconds': 0.0}
+
+    def _track(self, delta):
+        with self._lock:
+            self.stats['in_flight'] += delta
+            if delta > 0:
+                self.stats['requests'] += 1
+                self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.stats['in_flight'])
+
+    def request(self, method, url, *args, **kwargs):
+        for attempt in range(self.max_429_retries + 1):
+            self.bucket.acquire()
+            self._track(1)
+            start = time.perf_counter()
+            endpoint = telemetry.endpoint(url)
+            try:
+                with telemetry.span('spotify', method=method, endpoint=endpoint):
+                    response = super().request(method, url, *args, **kwargs)
+                telemetry.incr('spotify_requests_total', method=method, endpoint=endpoint, status=response.status_code)
+            except Exception:
+                with self._lock:
+                    self.stats['errors'] += 1
+                raise
+            finally:
+                self._track(-1)
+                with self._lock:
+                    self.stats['seconds'] += time.perf_counter() - start
+            if response.status_code != 429 or attempt == self.max_429_retries:
+                return response
+            wait_for = retry_after(response.headers)
+            telemetry.incr('spotify_throttled_total')
+            if not self.bucket.pause(wait_for):
+                log.warning('Spotify returned 429 for %s %s with Retry-After %ss, giving up', method, endpoint, wait_for)
+                telemetry.incr('spotify_throttled_failed_total')
+                return response
+            log.warning('Spotify returned 429 for %s %s, waiting %ss', method, endpoint, wait_for)
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats['throttled'] = self.bucket.throttled
+        stats['seconds_waiting'] = self.bucket.waited
+        return stats
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_shared_session(rate=RATE, burst=BURST, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                       max_retries=MAX_RETRIES, max_pause=MAX_PAUSE, **ignored):
+    """Return the process-wide RateLimitedSession, creating it on first use."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = RateLimitedSession(TokenBucket(rate, burst, max_pause), pool_connections, pool_maxsize, max_retries)
+        return _session
+
+def metrics():
+    """Request counts, in-flight requests and throttling for the shared session."""
+    return _session.metrics() if _session is not None else {}
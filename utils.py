@@ -6,53 +6,313 @@ Created on Sat Mar 22 12:43:40 2025
 @author: michaelsadowski
 """
 
+import hashlib
 import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from tenacity import retry, wait_random_exponential, stop_after_attempt
-from difflib import SequenceMatcher
+import cache
+import telemetry
+from playback import PlaybackState, get_playback_state
+from playlist_index import WRITE_THRESHOLD, match_playlist
+from singleflight import flights
 
 GPT_MODEL = 'gpt-4o-mini'
+TEMPERATURE = 0.3
+
+SEARCH_MAX_WORKERS = 8   # concurrent sp.search calls when resolving a track list
+SEARCH_TIMEOUT = 15      # seconds allowed for resolving a whole track list
+PLAYLIST_WRITE_CHUNK = 100   # Spotify accepts at most 100 items per playlist_add_items call
+TRACK_ID = re.compile(r'[0-9A-Za-z]{22}')   # a Spotify track ID
+
+log = telemetry.get_logger('utils')
+
+# a library.LibraryMirror that playlist reads are served from, set from config.toml; None reads from Spotify
+library = None
+
+def request_key(messages, tools, tool_choice, model):
+    """Identical model requests get the same key, so concurrent ones can share one call."""
+    body = json.dumps([model, TEMPERATURE, messages, tools, tool_choice], sort_keys=True, default=str)
+    return hashlib.sha256(body.encode()).hexdigest()
 
 @retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
 def chat_request(openai_client, messages, tools=None, tool_choice=None, model=GPT_MODEL):
+    def create():
+        with telemetry.span('llm', mode='request'):
+            response = openai_client.responses.create(
+                model=model,
+                input=messages,
+                tools=tools,
+                tool_choice=tool_choice,
+                temperature=TEMPERATURE
+            )
+        telemetry.incr('llm_requests_total', mode='request')
+        telemetry.record_usage(getattr(response, 'usage', None))
+        return response
     try:
-        response = openai_client.responses.create(
+        return flights.do('llm', request_key(messages, tools, tool_choice, model), create)
+    except Exception as e:
+        log.warning("Unable to generate ChatCompletion response: %s", e)
+        telemetry.incr('llm_errors_total')
+        return e
+
+@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(3))
+def chat_request_stream(openai_client, messages, tools=None, tool_choice=None, model=GPT_MODEL, on_function_call=None):
+    """Like chat_request, but returns a StreamingResponse that yields text as it arrives."""
+    def create():
+        stream = openai_client.responses.create(
             model=model,
             input=messages,
             tools=tools,
             tool_choice=tool_choice,
-            temperature=0.3
+            temperature=TEMPERATURE,
+            stream=True
         )
-        return response
+        telemetry.incr('llm_requests_total', mode='stream')
+        return _record_stream_usage(stream)
+    try:
+        # an identical request already streaming is read from the start instead of being sent again
+        stream, shared = flights.stream('llm_stream', request_key(messages, tools, tool_choice, model), create)
+        if shared:
+            log.debug("reading a stream another request started")
+        return StreamingResponse(stream, on_function_call)
     except Exception as e:
-        print("Unable to generate ChatCompletion response")
-        print(f"Exception: {e}")
+        log.warning("Unable to generate ChatCompletion response: %s", e)
+        telemetry.incr('llm_errors_total')
         return e
 
-def create_track_list(sp,args):
-    
+def _record_stream_usage(stream):
+    # on the stream itself rather than its readers, so a shared stream is counted once, whoever reads the end
+    for event in stream:
+        if event.type == 'response.completed':
+            telemetry.record_usage(getattr(event.response, 'usage', None))
+        yield event
+
+class StreamingResponse:
+    """Consumes a streamed Responses API call.
+
+    text_deltas() yields the text as it arrives (for st.write_stream) while
+    function-call arguments are assembled on the side. As soon as a call's
+    arguments are complete, on_function_call(name, args) is invoked, before
+    the rest of the stream has been read.
+    """
+    def __init__(self, stream, on_function_call=None):
+        self.stream = stream
+        self.on_function_call = on_function_call
+        self.text = ''
+        self.function_calls = []   # {'call_id', 'name', 'args'} in the order they completed
+        self.response = None       # the final response object, once the stream is done
+        self._pending = {}         # output item id -> [call_id, name, partial arguments]
+        self._started = time.perf_counter()
+        self._first_event = True
+
+    def text_deltas(self):
+        for event in self.stream:
+            if self._first_event and event.type in ('response.output_text.delta', 'response.output_item.added'):
+                self._first_event = False
+                telemetry.observe('llm_first_output', time.perf_counter() - self._started)
+            if event.type == 'response.output_text.delta':
+                self.text += event.delta
+                yield event.delta
+            elif event.type == 'response.output_item.added' and event.item.type == 'function_call':
+                self._pending[event.item.id] = [event.item.call_id, event.item.name, '']
+            elif event.type == 'response.function_call_arguments.delta':
+                self._pending[event.item_id][2] += event.delta
+            elif event.type == 'response.function_call_arguments.done':
+                call_id, name, partial = self._pending.pop(event.item_id)
+                args = json.loads(event.arguments or partial or '{}')
+                self.function_calls.append({'call_id': call_id, 'name': name, 'args': args})
+                if self.on_function_call:
+                    self.on_function_call(name, args)
+            elif event.type == 'response.completed':
+                self.response = event.response
+                telemetry.observe('llm', time.perf_counter() - self._started, mode='stream')
+
+    def details(self):
+        """Read whatever is left of the stream and return (response_text, function_name, function_args),
+        like extract_response_details."""
+        for delta in self.text_deltas():
+            pass
+        last = self.function_calls[-1] if self.function_calls else {'name': None, 'args': None}
+        return self.text or None, last['name'], last['args']
+
+def search_track(sp, track, artist):
+    """Look up one track on Spotify. Returns (id, artist, song_name) or None."""
+    def fetch():
+        query = f"track:{track} artist:{artist}"
+
+        results = flights.do('search', ('track', query), lambda: sp.search(q=query, type='track', limit=5)) # Limit is optional, defaults to 20
+
+        if results['tracks']['items'] != []:
+            item = results['tracks']['items'][0]
+            return item['id'], item['album']['artists'][0]['name'], item['name']
+        return None
+
+    found = cache.entity_cache.lookup('track', track, artist, fetch)
+    return tuple(found) if found else None
+
+def search_album(sp, album, artist):
+    """Look up an album on Spotify. Returns the album id or None."""
+    def fetch():
+        query = f"album:{album} artist:{artist}"
+
+        search_results = flights.do('search', ('album', query), lambda: sp.search(q=query, type='album', limit=2)) # Limit is optional, defaults to 20
+        if search_results['albums']['items'] == []:
+            return None
+        return search_results['albums']['items'][0]['id']
+
+    return cache.entity_cache.lookup('album', album, artist, fetch)
+
+def search_artist(sp, artist):
+    """Look up an artist on Spotify. Returns the artist id or None."""
+    def fetch():
+        query = f"artist:{artist}"
+
+        search_results = flights.do('search', ('artist', query), lambda: sp.search(q=query, type='artist', limit=3)) # Limit is optional, defaults to 20
+        if search_results['artists']['total'] == 0:
+            return None
+        return search_results['artists']['items'][0]['id']
+
+    return cache.entity_cache.lookup('artist', artist, '', fetch)
+
+def known_track(rec, entities=None):
+    """The search_track() tuple for a rec that needs no search: it carries the ID of a listed track, or
+    the session's EntityMemory remembers its name. None otherwise."""
+    track_id = rec.get('track_id')
+    if track_id and TRACK_ID.fullmatch(track_id):
+        telemetry.incr('listing_id_hits_total')
+        remembered = entities.get(track_id) if entities is not None else None
+        return track_id, rec['artist'], remembered[0] if remembered else rec['track_name']
+    found = entities.resolve(rec['track_name'], rec['artist']) if entities is not None else None
+    if found:
+        telemetry.incr('entity_memory_hits_total')
+    return found
+
+def find_track(sp, rec, entities=None):
+    """search_track() for a rec, answered locally when known_track() can."""
+    return known_track(rec, entities) or search_track(sp, rec['track_name'], rec['artist'])
+
+def resolve_tracks(sp, rec_list, max_workers=SEARCH_MAX_WORKERS, timeout=SEARCH_TIMEOUT, entities=None):
+    """Search for every (track_name, artist) rec concurrently.
+
+    Returns a list with one entry per rec, in input order: the search_track()
+    tuple, or None when the track could not be found, the search failed or
+    it did not finish before the deadline (timeout seconds for the whole batch).
+    Recs that entities (an EntityMemory) remembers are not searched.
+    """
+    if not rec_list:
+        return []
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(rec_list))))
+    futures = [executor.submit(telemetry.propagate(find_track), sp, rec, entities) for rec in rec_list]
+    wait(futures, timeout=timeout)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    resolved = []
+    for rec, future in zip(rec_list, futures):
+        if future.done() and not future.cancelled() and future.exception() is None:
+            resolved.append(future.result())
+        else:
+            if future.done() and not future.cancelled():
+                log.warning("Search failed for %s by %s: %r", rec['track_name'], rec['artist'], future.exception())
+            resolved.append(None)
+    return resolved
+
+def create_track_list(sp,args,max_workers=SEARCH_MAX_WORKERS,timeout=SEARCH_TIMEOUT,entities=None):
+    """Resolve args['tracks'] to Spotify IDs.
+
+    Returns (track_ids_to_add, tracks_to_add, unresolved): the IDs and
+    (id, artist, song_name) tuples of the tracks found, in the order the model
+    gave them, and the recs that could not be resolved.
+    """
     rec_list = args['tracks']
-    
+
     tracks_to_add = []
     track_ids_to_add = []
-    
-    for rec in rec_list:
+    unresolved = []
 
-        artist = rec['artist']
-        track = rec['track_name']
-        query = f"track:{track} artist:{artist}"  
-    
-        results = sp.search(q=query, type='track', limit=5) # Limit is optional, defaults to 20  
-        
-        print(f'search results = {results}')
-        
-        if results['tracks']['items'] != []:
-            artist = results['tracks']['items'][0]['album']['artists'][0]['name']
-            song_name = results['tracks']['items'][0]['name']
-            id= results['tracks']['items'][0]['id']
+    for rec, found in zip(rec_list, resolve_tracks(sp, rec_list, max_workers, timeout, entities)):
+        if found is None:
+            unresolved.append(rec)
+        else:
+            tracks_to_add.append(found)
+            track_ids_to_add.append(found[0])
+
+    if unresolved:
+        log.info('%d of %d tracks could not be resolved', len(unresolved), len(rec_list))
+    return track_ids_to_add, tracks_to_add, unresolved
+
+def paginate(sp, page, prefetch=True):
+    """Yield every item of a paged Spotify result, fetching later pages lazily.
+
+    With prefetch the next page is requested on a background thread while the
+    items of the current one are being consumed. Only one page is held at a time.
+    """
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        while page:
+            next_page = None
+            if executor and page.get('next'):
+                next_page = executor.submit(telemetry.propagate(sp.next), page)
+            yield from page['items']
+            if next_page is not None:
+                page = next_page.result()
+            elif page.get('next'):
+                page = sp.next(page)
+            else:
+                page = None
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
 
-            tracks_to_add += (id,artist,song_name)
-            track_ids_to_add.append(id)  
-    return track_ids_to_add, tracks_to_add
+def chunked(items, size=PLAYLIST_WRITE_CHUNK):
+    """Yield lists of at most size items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def track_artist(track):
+    """The first artist's name of a Spotify track object, or None."""
+    artists = track.get('artists')
+    return artists[0]['name'] if artists else None
+
+def iter_playlist_tracks(sp, playlist_id):
+    """Yield (track_name, track_id, artist) for every track in a playlist, skipping local files and removed tracks."""
+    if library is not None:
+        yield from library.playlist_tracks(sp, playlist_id)
+        return
+    for r in paginate(sp, sp.playlist_tracks(playlist_id)):
+        if r.get('track') and r['track'].get('id'):
+            yield r['track']['name'], r['track']['id'], track_artist(r['track'])
+
+_prefetch_executor = ThreadPoolExecutor(max_workers=4)
+
+def prefetch_tool(sp, function_name, function_args, entities=None):
+    """Start the Spotify searches a tool call will need on a background thread.
+
+    Called while the model's response is still streaming; the results land in
+    the entity cache, so the real call finds them there. Nothing is changed
+    in the user's account.
+    """
+    def run():
+        try:
+            if function_name in ('add_to_playlist', 'add_to_queue', 'play_track'):
+                resolve_tracks(sp, function_args['tracks'], entities=entities)
+            elif function_name == 'album_tracks':
+                search_album(sp, function_args['album'][0]['album_name'], function_args['album'][0]['artist'])
+            elif function_name == 'play_album':
+                search_album(sp, function_args['albums'][0]['album_name'], function_args['albums'][0]['artist'])
+            elif function_name == 'top_tracks':
+                search_artist(sp, function_args['artist_name'])
+        except Exception as e:
+            log.warning('prefetch for %s failed: %r', function_name, e)
+    return _prefetch_executor.submit(telemetry.propagate(run))
 
 def extract_response_details(response):
     """Extracts response text and function call details from OpenAI API response."""
@@ -69,38 +329,163 @@ def extract_response_details(response):
 
     return response_text, function_name, function_args
 
-def clear_queue(sp):
-    currently_playing = sp.currently_playing()
-    queue = sp.queue()
-    
-    if queue['queue'] and currently_playing: # skip through queue. There is no API call to clear the queue directly
-        for i in range(len(queue['queue'])-1):
+def extract_function_calls(response):
+    """Every function call in the response, as {'call_id', 'name', 'args'} dicts in order."""
+    return [{'call_id': item.call_id, 'name': item.name, 'args': json.loads(item.arguments or '{}')}
+            for item in response.output if item.type == "function_call"]
+
+def function_call_items(results):
+    """Input items that replay [(call, ToolResult)] to the model for a follow-up request."""
+    items = []
+    for call, result in results:
+        items.append({"type": "function_call", "call_id": call['call_id'], "name": call['name'], "arguments": json.dumps(call['args'] or {})})
+        items.append({"type": "function_call_output", "call_id": call['call_id'], "output": result.model_output()})
+    return items
+
+class CallCounter:
+    """Wraps a Spotify client and counts the API calls made through it."""
+    def __init__(self, sp):
+        self.sp = sp
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.sp, name)
+        if not callable(attr):
+            return attr
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return attr(*args, **kwargs)
+        return counted
+
+def _skip_queue(sp, state):
+    # the original approach: one next_track call per queued item
+    for i in range(len(state.queue)-1):
+        sp.next_track()
+    state.skipped()
+    return True
+
+def _restart_queue(sp, state):
+    # Restarting the current track as a one-track list of URIs replaces the
+    # context, which drops the upcoming context tracks. Tracks the user queued
+    # ("Next in queue", which is what add_to_queue fills) survive a new
+    # context, so read the queue again and skip past any old entries still at
+    # its front, then restart the track once more to get back to where it was.
+    # That costs more calls than _skip_queue whenever the user queued
+    # anything, ends the playlist or album being played (playback stops after
+    # the current track) and briefly resumes paused playback. Opt-in only.
+    current = state.current
+    item = current.get('item') if current else None
+    if not item or not item.get('uri'):
+        return False
+    old_ids = set(q.get('id') for q in state.queue)
+    was_playing = state.is_playing()
+    position_ms = current.get('progress_ms') or 0
+
+    sp.start_playback(uris=[item['uri']], position_ms=position_ms)
+    result = sp.queue()
+    remaining = result['queue'] if result else []
+    # anything queued after the reset (e.g. autoplay) is fine, old entries are not
+    skips = max((i + 1 for i, q in enumerate(remaining) if q.get('id') in old_ids), default=0)
+    if skips:
+        for i in range(skips):   # bounded by the queue we just read
             sp.next_track()
-        return True
+        sp.start_playback(uris=[item['uri']], position_ms=position_ms)
+        result = sp.queue()
+        remaining = result['queue'] if result else []
+    if not was_playing:
+        sp.pause_playback()
+    state.started(item)
+    state.set_playing(was_playing)
+    state.set_queue(remaining)
+    return not any(q.get('id') in old_ids for q in remaining)
+
+QUEUE_RESET_STRATEGIES = {'restart': _restart_queue, 'skip': _skip_queue}
+
+def reset_queue(sp, strategy='skip'):
+    """Clear the queue and measure the cost.
+
+    The Web API has no call that clears the queue, and none that removes the
+    tracks the user queued in a bounded number of calls: 'skip' takes one call
+    per queued track. 'restart' (see _restart_queue) is kept for comparison.
+
+    Returns a dict with whether the queue was cleared, the number of Spotify
+    calls made (including reading the playback state) and the time taken.
+    """
+    start_time = time.perf_counter()
+    counter = CallCounter(sp)
+    # read the state fresh, through the counter, then hand the result to the shared snapshot
+    state = PlaybackState(counter)
+    queue_length = len(state.queue)
+    if state.queue and state.current:
+        cleared = QUEUE_RESET_STRATEGIES[strategy](counter, state)
     else: # queue might have been empty
-        return False
+        cleared = False
+    get_playback_state(sp).adopt(state)
+    report = {'strategy': strategy, 'cleared': cleared, 'queue_length': queue_length,
+              'calls': counter.calls, 'seconds': time.perf_counter() - start_time}
+    log.info('queue reset: %s', report)
+    return report
+
+def clear_queue(sp, strategy='skip'):
+    # There is no API call to clear the queue directly
+    return reset_queue(sp, strategy)['cleared']
+
+def queue_tracks(sp, rec_list, max_workers=SEARCH_MAX_WORKERS, timeout=SEARCH_TIMEOUT, entities=None):
+    """Resolve and queue tracks as a pipeline.
+
+    All searches start at once. Each track is added to the queue as soon as
+    it and every track before it are resolved, so the queue order matches
+    rec_list and the first track is queued after one search and one add.
+    Yields (rec, found) per rec, in order; found is the search_track() tuple
+    or None when the track could not be resolved or queued. Rate limiting and
+    429 retries are left to the shared transport session.
+    """
+    if not rec_list:
+        return
+    state = get_playback_state(sp)
+    deadline = time.monotonic() + timeout
 
-def add_items_to_queue(sp,args):   
-    track_ids_to_add, tracks_to_add = create_track_list(sp,args)
-    devices = sp.devices()['devices'][0]
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(rec_list))))
+    futures = [executor.submit(telemetry.propagate(find_track), sp, rec, entities) for rec in rec_list]
+    try:
+        for rec, future in zip(rec_list, futures):
+            try:
+                found = future.result(timeout=max(0, deadline - time.monotonic()))
+            except Exception as e:
+                log.warning("Search failed for %s by %s: %r", rec['track_name'], rec['artist'], e)
+                found = None
+            if found:
+                try:
+                    sp.add_to_queue(found[0], device_id=None)
+                    state.queued([found[0]])
+                except Exception as e:
+                    log.warning("Could not queue %s: %s", found, e)
+                    found = None
+            yield rec, found
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def add_items_to_queue(sp,args,progress=None,entities=None):
+    """Queue args['tracks']. progress(rec, found) is called as each track is done."""
+    state = get_playback_state(sp)
    
-    if devices['is_active'] and track_ids_to_add != []:
-        for t in track_ids_to_add:              
-            sp.add_to_queue(t, device_id=None)  
-        return True
-    else:
+    if not state.device_active() or not args['tracks']:
         return False
+
+    queued = 0
+    for rec, found in queue_tracks(sp, args['tracks'], entities=entities):
+        if found:
+            queued += 1
+        if progress:
+            progress(rec, found)
+    return queued > 0
     
 def top_tracks(sp,artist):
-    query = f"artist:{artist['artist_name']}"  
-   
-    search_results = sp.search(q=query, type='artist', limit=3) # Limit is optional, defaults to 20  
-    print(f'Search results: {search_results}') 
+    artist_id = search_artist(sp, artist['artist_name'])
     track_list = []
     tracks_string = ''
-    if search_results['artists']['total'] != 0:
-        artist_id = search_results['artists']['items'][0]['id']
-        results = sp.artist_top_tracks(artist_id)
+    if artist_id:
+        results = flights.do('artist_top_tracks', artist_id, lambda: sp.artist_top_tracks(artist_id))
         if results['tracks']!= []:
             for r in results['tracks']:          
                 track_id = r['id']
@@ -109,88 +494,74 @@ def top_tracks(sp,artist):
                 tracks_string += track_name + '  \n'
         return tracks_string, track_list
     else:
-        print("Can't find artist id.")
+        log.info("Can't find artist id for %s", artist['artist_name'])
         return tracks_string, track_list
 
 def playlist_tracks(sp,playlist,user_playlists):
     # get user playlists ad try to match the name. Close enough is OK
     playlist_id = ''
-    for p in user_playlists:
-        if SequenceMatcher(None, p[0], playlist['playlist_name']).ratio()> 0.85:
-           playlist_id = p[1]
-           break
-       
+    match = match_playlist(user_playlists, playlist['playlist_name'])
+    if match:
+        log.debug('matched playlist %s', match)
+        playlist_id = match[1]
+
     track_list = []
     tracks_string = ''
     if playlist_id != '':
-        results = sp.playlist_tracks(playlist_id)
-
-        if results['items']!= []:
-            for r in results['items']:          
-                track_id = r['track']['id']
-                track_name = r['track']['name']
-                track_list.append((track_name,track_id))   
-                tracks_string += track_name + '  \n'
+        for track_name, track_id, artist in iter_playlist_tracks(sp, playlist_id):
+            track_list.append((track_name,track_id,artist))   
+            tracks_string += track_name + '  \n'
     return tracks_string, track_list
     
 
 def album_tracks(sp,args):
-    query = f"album:{args['album'][0]['album_name']} artist:{args['album'][0]['artist']}"  
-   
-    search_results = sp.search(q=query, type='album', limit=2) # Limit is optional, defaults to 20  
-    print(f"search_results = {search_results}")
-    if search_results['albums']['items'] == []:
+    album_id = search_album(sp, args['album'][0]['album_name'], args['album'][0]['artist'])
+    if not album_id:
         return '',[]
     else:
-        album_id = search_results['albums']['items'][0]['id']
-        results = sp.album_tracks(album_id)
         track_list = []
         tracks_string = ''
-        if results['items']!= []:
-            for r in results['items']:          
-                track_id = r['id']
-                track_name = r['name']
-                track_list.append((track_name,track_id))   
-                tracks_string += track_name + '  \n'
+        for r in flights.do('album_tracks', album_id, lambda: list(paginate(sp, sp.album_tracks(album_id)))):
+            track_id = r['id']
+            track_name = r['name']
+            track_list.append((track_name,track_id))   
+            tracks_string += track_name + '  \n'
         return tracks_string, track_list
 
 def pause(sp):
-    devices = sp.devices()
-    currently_playing = sp.currently_playing()
+    state = get_playback_state(sp)
     
-    if devices['devices'] == []:
+    if not state.has_devices():
         return False    
-    elif devices['devices'][0]['is_active'] and currently_playing['is_playing']==True:     
+    elif state.device_active() and state.is_playing():     
         result = sp.pause_playback()
+        state.set_playing(False)
         return True
     else:
         return False
 
 def start(sp):
-    devices = sp.devices()
-    currently_playing = sp.currently_playing()
+    state = get_playback_state(sp)
 
-    if devices['devices'] == []:
+    if not state.has_devices():
         return False    
-    elif devices['devices'][0]['is_active'] and currently_playing['is_playing']==False: 
+    elif state.device_active() and not state.is_playing(): 
         result = sp.start_playback()
+        state.set_playing(True)
         return True
     else:
         return False
 
-def play_track(sp,args):
-    track_ids_to_add, tracks_to_add = create_track_list(sp,args)
-    print(f'track IDs to add: {track_ids_to_add}')
-    devices = sp.devices()
-    #print(devices)
-    #currently_playing = sp.currently_playing()    
+def play_track(sp,args,entities=None):
+    track_ids_to_add, tracks_to_add, unresolved = create_track_list(sp,args,entities=entities)
+    state = get_playback_state(sp)
    
-    if devices['devices'] == []:
+    if not state.has_devices():
         return False    
-    elif devices['devices'][0]['is_active'] and len(track_ids_to_add) == 1:
+    elif state.device_active() and len(track_ids_to_add) == 1:
         uri = f'spotify:track:{track_ids_to_add[0]}'
-        print(f'uri to add: {uri}')
         sp.start_playback(uris = [uri])
+        state.started({'id': track_ids_to_add[0], 'uri': uri})
         return True
     else:
         return False
@@ -198,99 +569,90 @@ def play_track(sp,args):
 def play_playlist(sp,args):
     #get all playists
     playlist_string, playlist_list = get_playlists(sp)  
-    print(playlist_list)
-    
     # find the desired playlist
     pid = ''
-    for p in playlist_list:
-       if p[0] == args['playlist_name']:
-           pid = p[1]
-           print(f'found playlist {pid}')
-           break
-       
-    devices = sp.devices()
-    #currently_playing = sp.currently_playing()   
-
-    if devices['devices'] == []:
+    match = match_playlist(playlist_list, args['playlist_name'])
+    if match:
+        pid = match[1]
+        log.debug('matched playlist %s', match)
+
+    state = get_playback_state(sp)
+
+    if not state.has_devices():
         return False      
-    if devices['devices'][0]['is_active'] and pid != '':
-        print('starting playback')
+    if state.device_active() and pid != '':
         sp.start_playback(context_uri = "spotify:playlist:"+pid)
+        state.started()
         return True
     else:
         return False
     
 def play_album(sp,args):
-   query = f"album:{args['albums'][0]['album_name']} artist:{args['albums'][0]['artist']}"  
-  
-   search_results = sp.search(q=query, type='album', limit=2) 
-   print(f"search_results = {search_results}")
-   if search_results['albums']['items'] != []:
-       devices = sp.devices()
-       if devices['devices'] == []:
+   album_id = search_album(sp, args['albums'][0]['album_name'], args['albums'][0]['artist'])
+   if album_id:
+       state = get_playback_state(sp)
+       if not state.has_devices():
            return False  
 
-       #currently_playing = sp.currently_playing()   
-       elif devices['devices'][0]['is_active']:
-           print('starting playback')
-           album_id = search_results['albums']['items'][0]['id']
+       elif state.device_active():
            context_uri = "spotify:album:"+album_id
            sp.start_playback(context_uri = context_uri)
+           state.started()
            return True
    else:
        return False
 
 def get_playlists(sp):
-    result = sp.current_user_playlists(limit=50)
+    if library is not None:
+        playlist_list = [tuple(p) for p in library.playlists(sp)]
+        return ''.join(name + '  \n' for name, pid in playlist_list), playlist_list
     playlist_list = []
     playlist_string = ''
-    for p in result['items']:
+    for p in paginate(sp, sp.current_user_playlists(limit=50)):
         playlist_list.append((p['name'],p['id']))    
         playlist_string += p['name'] + '  \n'
     return playlist_string, playlist_list
 
-def add_items_to_playlist(sp,args):    
+def add_items_to_playlist(sp,args,entities=None):    
     
-    track_ids_to_add, tracks_to_add = create_track_list(sp,args)
-    print(f'track_ids_to_add = {track_ids_to_add}')
+    track_ids_to_add, tracks_to_add, unresolved = create_track_list(sp,args,entities=entities)
     
     playlist_name = args['playlist_name']
     
     new_list = args['new_flag']
     
-    user_profile = sp.current_user()
-    user_id = user_profile['id']
-    #print(user_profile)
-    
     if new_list: #create new list if needed
+        user_id = library.user_id(sp) if library is not None else sp.current_user()['id']
         playlist = sp.user_playlist_create(user=user_id,name=playlist_name,public=False,collaborative=False,description='My new playlist')  
         pid = playlist['id']
-        delta_tracks = set(track_ids_to_add)
-        print(f'delta tracks = {delta_tracks}')
+        existing_tracks_set = set()
+        if library is not None:
+            library.created(sp, playlist)
     else:   # add to an existing list
-        playlists = sp.user_playlists(user_id)
-        for p in playlists['items']:
-           if p['name'] == playlist_name:
-               pid = p['id']
-               break
-        print(f'playlist id found: {pid}')
+        pid = ''
+        playlist_string, playlist_list = get_playlists(sp)
+        match = match_playlist(playlist_list, playlist_name, WRITE_THRESHOLD)
+        if match:
+            pid = match[1]
+        log.debug('matched playlist %s', match)
         if pid:   # found the playlist
-            existing_tracks = sp.user_playlist_tracks(user=user_id, playlist_id=pid)
-            existing_tracks = sp.playlist_tracks(playlist_id=pid)
-            
-            existing_tracks_set = set()
-            for i in existing_tracks['items']:
-                track_id = i['track']['id']
-                existing_tracks_set.add(track_id)
-            tracks_ids_to_add_set = set(track_ids_to_add)
-                
-            delta_tracks = tracks_ids_to_add_set - existing_tracks_set
-            print(f'delta tracks = {delta_tracks}')
+            existing_tracks_set = set(track_id for track_name, track_id, artist in iter_playlist_tracks(sp, pid))
         else:   # could not find the play list
             return False
-                   
-    if delta_tracks != set():
-        sp.playlist_add_items(playlist_id=pid, items=list(delta_tracks))  # add items
+
+    # keep the order the tracks were given in, and don't add the same track twice
+    delta_tracks = []
+    for track_id in track_ids_to_add:
+        if track_id not in existing_tracks_set:
+            existing_tracks_set.add(track_id)
+            delta_tracks.append(track_id)
+    log.debug('%d of %d tracks are new to the playlist', len(delta_tracks), len(track_ids_to_add))
+
+    if delta_tracks != []:
+        names = {track_id: (name, artist) for track_id, artist, name in tracks_to_add}
+        for chunk in chunked(delta_tracks):
+            result = sp.playlist_add_items(playlist_id=pid, items=chunk)  # add items
+            if library is not None:   # keep the mirror in step, so the next read needs no fetch
+                library.added(pid, [(names[track_id][0], track_id, names[track_id][1]) for track_id in chunk], result['snapshot_id'])
         return True
     else: return False
-